@@ -1,3 +1,5 @@
+import os
+import sys
 import numpy as np
 import gym
 import pygame
@@ -40,10 +42,10 @@ def process_input(key_bindings, steering_sensitivity=1.0, action_intensity=1.0):
 def handle_step(env, action):
     """Perform a step in the environment and return updated information."""
     observation, reward, terminated, truncated, info = env.step(action)
-    return observation, reward, terminated, truncated
+    return observation, reward, terminated, truncated, info
 
-def game_loop(env, clock, fps, key_bindings, steering_sensitivity, action_intensity):
-    """Main game loop where the action and environment are updated."""
+def game_loop(env, clock, fps, key_bindings, steering_sensitivity, action_intensity, recorder=None):
+    """Main game loop where the action and environment are updated, optionally recording every step."""
     total_reward = 0.0
     observation = env.reset()
     done = False
@@ -54,8 +56,10 @@ def game_loop(env, clock, fps, key_bindings, steering_sensitivity, action_intens
             done = True
             break
 
-        observation, reward, terminated, truncated = handle_step(env, action)
+        observation, reward, terminated, truncated, info = handle_step(env, action)
         total_reward += reward
+        if recorder is not None:
+            recorder.record(observation, action, reward, info, terminated=terminated, truncated=truncated)
         env.render()
         clock.tick(fps)
 
@@ -70,7 +74,8 @@ def close_environment(env):
     env.close()
     pygame.quit()
 
-def drive(env_name='CarRacing-v2', render_mode='human', fps=60, steering_sensitivity=1.0, action_intensity=1.0, key_bindings=None):
+def drive(env_name='CarRacing-v2', render_mode='human', fps=60, steering_sensitivity=1.0, action_intensity=1.0, key_bindings=None,
+          record_path=None):
     """Main function to run the car driving simulation with customizable parameters."""
     
     # Default key bindings if none provided
@@ -90,7 +95,17 @@ def drive(env_name='CarRacing-v2', render_mode='human', fps=60, steering_sensiti
     clock, fps = initialize_pygame(fps)
 
     logging.info("Starting game loop...")
-    total_reward = game_loop(env, clock, fps, key_bindings, steering_sensitivity, action_intensity)
+    recorder = None
+    if record_path is not None:
+        logging.info(f"Recording session to {record_path}")
+        # The recorder of the modular pipeline in 05_sdc-pipeline
+        sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '05_sdc-pipeline'))
+        from session_log import SessionRecorder
+        recorder = SessionRecorder(record_path)
+    total_reward = game_loop(env, clock, fps, key_bindings, steering_sensitivity, action_intensity, recorder)
+    if recorder is not None:
+        recorder.close()
+        logging.info(f"Recorded {recorder.num_steps} steps")
 
     logging.info(f"Total reward for this session: {total_reward}")
     logging.info("Closing environment...")
@@ -112,5 +127,6 @@ if __name__ == "__main__":
         fps=60,
         steering_sensitivity=1.0,  # Customize steering sensitivity
         action_intensity=1.0,      # Customize gas/brake intensity
-        key_bindings=custom_key_bindings  # Use custom key bindings
+        key_bindings=custom_key_bindings,  # Use custom key bindings
+        record_path=None  # Log directory to record the session for session_log.py, e.g. 'session_log'
     )
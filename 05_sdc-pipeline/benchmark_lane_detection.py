@@ -0,0 +1,274 @@
+import io
+import os
+import re
+import time
+import zipfile
+import argparse
+
+import numpy as np
+
+from lane_detection import LaneDetection
+from spline_fitting import evaluate_spline
+from tracing import TRACER
+
+DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+TEACHER_ZIP = os.path.join(DIRECTORY, '..', '02_imitation-learning', 'data', 'teacher.zip')
+# Lane boundary columns of the baseline detector (scipy.signal.find_peaks maxima and splprep)
+# on the teacher frames, so that changes of the detector itself show up as deviations
+GOLDEN_FILE = os.path.join(DIRECTORY, 'data', 'lane_detection_golden.npz')
+
+# Rows of the cut image at which the columns of the lane boundaries are compared
+SAMPLE_ROWS = np.arange(0, 68, 4)
+# Spline parameters evaluated to find the columns at the sample rows
+NUM_SAMPLES = 200
+# Splines leaving the image by more than this many pixels count as diverged
+DIVERGENCE_MARGIN = 68
+
+
+def load_teacher_observations(zip_path=TEACHER_ZIP):
+    '''
+    Loads all observation_<index>.npy frames of the teacher demonstrations in index order.
+
+    args:
+        zip_path: Path of teacher.zip
+
+    output:
+        frames: [N, 96, 96, 3] uint8 array
+    '''
+    with zipfile.ZipFile(zip_path) as archive:
+        names = [name for name in archive.namelist() if re.search(r'observation_\d+\.npy$', name)]
+        names.sort(key=lambda name: int(re.search(r'(\d+)\.npy$', name).group(1)))
+        return np.stack([np.load(io.BytesIO(archive.read(name))) for name in names])
+
+
+def columns_at_rows(points, rows=SAMPLE_ROWS):
+    '''
+    Columns at which a polyline first crosses each of the given rows, linearly interpolated.
+    Unlike samples at fixed spline parameters, these do not depend on the traced length.
+
+    args:
+        points: [2, num_points] columns and rows along the boundary
+
+    output:
+        [num_rows] columns, NaN for rows the boundary does not reach
+    '''
+    cols, point_rows = points
+    offsets = point_rows[None, :] - rows[:, None]
+    crossing = (offsets[:, :-1] * offsets[:, 1:] <= 0) & (offsets[:, :-1] != offsets[:, 1:])
+    first = np.argmax(crossing, axis=1)
+    row0, row1 = point_rows[first], point_rows[first + 1]
+    weight = (rows - row0) / np.where(row1 != row0, row1 - row0, 1)
+    columns = cols[first] + weight * (cols[first + 1] - cols[first])
+    columns[~crossing.any(axis=1)] = np.nan
+    return columns
+
+
+def sample_lane_boundaries(lane_boundaries):
+    '''
+    Columns of both lane boundary splines at SAMPLE_ROWS. A diverged spline, one that
+    leaves the image by more than DIVERGENCE_MARGIN pixels, has no valid columns.
+
+    output:
+        [2, len(SAMPLE_ROWS)] array, NaN if no lanes were detected
+    '''
+    samples = np.full((2, len(SAMPLE_ROWS)), np.nan)
+    if lane_boundaries[0] is None or lane_boundaries[1] is None:
+        return samples
+    for i, lane_boundary in enumerate(lane_boundaries):
+        points = evaluate_spline(lane_boundary, NUM_SAMPLES)
+        if np.all((points > -DIVERGENCE_MARGIN) & (points < 96 + DIVERGENCE_MARGIN)):
+            samples[i] = columns_at_rows(points)
+    return samples
+
+
+def run_benchmark(frames, LD_module):
+    '''
+    Runs the lane detection over all frames and measures the latency of every stage.
+    In tracking mode and with a frame cache only the total latency of lane_detection is measured,
+    in tracking mode also split into tracked, rejected and full-frame frames (NaN for the other frames).
+
+    args:
+        frames: [N, 96, 96, 3] array
+        LD_module: LaneDetection instance
+
+    output:
+        timings: dict of stage name to [N] latencies in seconds
+        samples: [N, 2, len(SAMPLE_ROWS)] lane boundary columns
+    '''
+    whole_calls = LD_module.tracking or LD_module.frame_cache is not None
+    if LD_module.tracking:
+        stages = ['tracked', 'rejected', 'full_frame', 'lane_detection']
+    elif whole_calls:
+        stages = ['lane_detection']
+    elif LD_module.engine == "color":
+        stages = ['segmentation', 'transitions', 'fit', 'lane_detection']
+    else:
+        stages = ['cut_gray', 'edge_detection', 'maxima', 'fit', 'lane_detection']
+    timings = {stage: np.full(frames.shape[0], np.nan) for stage in stages}
+    samples = np.zeros((frames.shape[0], 2, len(SAMPLE_ROWS)))
+
+    for i, frame in enumerate(frames):
+        if whole_calls:
+            is_tracking, num_tracked_frames = LD_module.is_tracking, LD_module.num_tracked_frames
+            start = time.perf_counter()
+            lane_boundaries = LD_module.lane_detection(frame)
+            timings['lane_detection'][i] = time.perf_counter() - start
+            if LD_module.tracking:
+                if not is_tracking:
+                    timings['full_frame'][i] = timings['lane_detection'][i]
+                elif LD_module.num_tracked_frames > num_tracked_frames:
+                    timings['tracked'][i] = timings['lane_detection'][i]
+                else:
+                    timings['rejected'][i] = timings['lane_detection'][i]
+        elif LD_module.engine == "color":
+            t0 = time.perf_counter()
+            grass_mask = LD_module.segment_grass(frame)
+            t1 = time.perf_counter()
+            maxima = LD_module.find_boundary_transitions(grass_mask)
+            t2 = time.perf_counter()
+            lane_boundaries = LD_module.fit_lane_boundaries(None, maxima)
+            t3 = time.perf_counter()
+            for stage, duration in zip(stages, (t1 - t0, t2 - t1, t3 - t2, t3 - t0)):
+                timings[stage][i] = duration
+        else:
+            # Same stages as the full-frame path of LaneDetection.lane_detection
+            t0 = time.perf_counter()
+            if LD_module.workspace is not None:
+                gray_state = LD_module.cut_gray_workspace(frame)
+                t1 = time.perf_counter()
+                gradient_sum = LD_module.edge_detection_workspace(gray_state)
+            else:
+                gray_state = LD_module.cut_gray(frame)
+                t1 = time.perf_counter()
+                gradient_sum = LD_module.edge_detection(gray_state)
+            t2 = time.perf_counter()
+            maxima = LD_module.find_maxima_gradient_rowwise(gradient_sum)
+            t3 = time.perf_counter()
+            lane_boundaries = LD_module.fit_lane_boundaries(gradient_sum, maxima)
+            t4 = time.perf_counter()
+            for stage, duration in zip(stages, (t1 - t0, t2 - t1, t3 - t2, t4 - t3, t4 - t0)):
+                timings[stage][i] = duration
+        samples[i] = sample_lane_boundaries(lane_boundaries)
+
+    return timings, samples
+
+
+def compare_to_golden(samples, golden_samples):
+    '''
+    Maximum column deviation per frame between the lane boundaries and the golden set,
+    over the rows both reach. The order of the two boundaries is ignored.
+
+    output:
+        [N] deviations in pixels, NaN where no row can be compared
+    '''
+    deviations = []
+    for order in (samples, samples[:, ::-1]):
+        difference = np.abs(order - golden_samples).reshape(len(samples), -1)
+        comparable = ~np.isnan(difference)
+        deviations.append(np.where(comparable.any(axis=1), np.max(np.where(comparable, difference, -np.inf), axis=1), np.nan))
+    return np.fmin(*deviations)
+
+
+def print_report(timings, deviations=None, tolerance=1.0):
+    '''
+    Prints latency percentiles per stage, the throughput and the accuracy against the golden set.
+    '''
+    print("{:<16}{:>10}{:>10}{:>10}{:>10}{:>10}".format("stage", "frames", "mean", "p50", "p95", "p99"))
+    for stage, latencies in timings.items():
+        microseconds = latencies[~np.isnan(latencies)] * 1e6
+        if len(microseconds) == 0:
+            continue
+        print("{:<16}{:>10}{:>10.1f}{:>10.1f}{:>10.1f}{:>10.1f}".format(
+            stage, len(microseconds), microseconds.mean(), *np.percentile(microseconds, [50, 95, 99])))
+    print("frames/sec {:.1f}".format(len(timings['lane_detection']) / timings['lane_detection'].sum()))
+
+    if deviations is not None:
+        valid = ~np.isnan(deviations)
+        print("\ngolden comparison over {} frames ({} without comparable rows, e.g. no detection or a diverged spline)".format(
+            len(deviations), np.sum(~valid)))
+        if valid.any():
+            print("deviation [px] p50 {:.3f} p95 {:.3f} p99 {:.3f} max {:.3f}".format(
+                *np.percentile(deviations[valid], [50, 95, 99]), deviations[valid].max()))
+            print("frames above {:.1f} px: {}".format(tolerance, np.sum(deviations[valid] > tolerance)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Lane detection latency and accuracy benchmark on the teacher frames")
+    parser.add_argument('--teacher', type=str, default=TEACHER_ZIP, help='path of teacher.zip')
+    parser.add_argument('--golden', type=str, default=GOLDEN_FILE, help='golden lane boundaries (.npz)')
+    parser.add_argument('--save_golden', default=False, action='store_true', help='store this run as the golden set')
+    parser.add_argument('--tolerance', type=float, default=1.0, help='deviation in pixels counted as regression')
+    parser.add_argument('--limit', type=int, default=None, help='only use the first frames')
+    parser.add_argument('--gradient_threshold', type=float, default=14)
+    parser.add_argument('--spline_smoothness', type=float, default=10)
+    parser.add_argument('--engine', type=str, default='gradient', choices=['gradient', 'color', 'both'],
+                        help='boundary extraction engine, both runs them side by side')
+    parser.add_argument('--tracking', default=False, action='store_true')
+    parser.add_argument('--use_workspace', default=False, action='store_true')
+    parser.add_argument('--frame_cache', type=int, default=0, help='frames in the result cache, 0 disables it')
+    parser.add_argument('--repeat', type=int, default=1, help='passes over the frames, e.g. to measure the frame cache')
+    parser.add_argument('--trace', type=str, default=None, help='write the stage spans as Chrome trace JSON')
+    args = parser.parse_args()
+
+    frames = load_teacher_observations(args.teacher)[:args.limit]
+    engines = ['gradient', 'color'] if args.engine == 'both' else [args.engine]
+    if args.trace:
+        TRACER.enable()
+    results = {}
+    for engine in engines:
+        LD_module = LaneDetection(gradient_threshold=args.gradient_threshold,
+                                  spline_smoothness=args.spline_smoothness,
+                                  tracking=args.tracking,
+                                  use_workspace=args.use_workspace,
+                                  engine=engine,
+                                  frame_cache_size=args.frame_cache)
+        # Every pass starts like a new session, the latencies of all passes are reported
+        passes = []
+        for _ in range(args.repeat):
+            LD_module.lane_boundary1_old = LD_module.lane_boundary2_old = None
+            LD_module.is_tracking = False
+            passes.append(run_benchmark(frames, LD_module))
+        timings = {stage: np.concatenate([pass_timings[stage] for pass_timings, _ in passes]) for stage in passes[0][0]}
+        results[engine] = (LD_module, timings, passes[-1][1])
+    TRACER.disable()
+
+    for engine, (LD_module, timings, samples) in results.items():
+        if len(engines) > 1:
+            print("\n{} engine".format(engine))
+        if args.save_golden:
+            # The golden set is the run of the first engine
+            if engine == engines[0]:
+                os.makedirs(os.path.dirname(os.path.abspath(args.golden)), exist_ok=True)
+                np.savez_compressed(args.golden, columns=samples.astype(np.float32), rows=SAMPLE_ROWS)
+                print("saved golden set of {} frames to {}\n".format(len(samples), args.golden))
+            deviations = None
+        elif os.path.exists(args.golden):
+            golden_samples = np.load(args.golden)['columns']
+            num_frames = min(len(golden_samples), len(samples))
+            deviations = compare_to_golden(samples[:num_frames], golden_samples[:num_frames])
+        else:
+            print("no golden set at {}, run with --save_golden to create it\n".format(args.golden))
+            deviations = None
+
+        print_report(timings, deviations, args.tolerance)
+        if LD_module.frame_cache is not None:
+            print("\nframe cache: {hits} hits, {misses} misses, hit rate {hit_rate:.1%}, {entries} entries, {nbytes} bytes".format(
+                **LD_module.frame_cache.stats()))
+
+    if len(engines) > 1:
+        deviations = compare_to_golden(results['color'][2], results['gradient'][2])
+        valid = ~np.isnan(deviations)
+        print("\nside by side: gradient {:.1f} frames/sec, color {:.1f} frames/sec".format(
+            *[len(results[engine][1]['lane_detection']) / results[engine][1]['lane_detection'].sum() for engine in engines]))
+        if valid.any():
+            print("color vs gradient deviation [px] p50 {:.3f} p95 {:.3f}, frames above {:.1f} px: {}".format(
+                *np.percentile(deviations[valid], [50, 95]), args.tolerance, np.sum(deviations[valid] > args.tolerance)))
+
+    if args.trace:
+        TRACER.export_chrome_trace(args.trace)
+        print("\nwrote trace to {}\n".format(args.trace))
+        TRACER.print_summary()
+
+
+if __name__ == "__main__":
+    main()
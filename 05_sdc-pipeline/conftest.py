@@ -0,0 +1,3 @@
+# The test_*.py scripts below drive the gym environment and are not unit tests
+collect_ignore = ["test_lane_detection.py", "test_lateral_control.py", "test_longitudinal_control.py",
+                  "test_waypoint_prediction.py"]
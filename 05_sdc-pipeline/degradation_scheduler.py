@@ -0,0 +1,127 @@
+import logging
+
+# Degradation levels, each one includes the degradations of the levels before
+NOMINAL = 0
+DEGRADED_WAYPOINTS = 1  # Closed-form instead of optimized waypoints
+REDUCED_ROW_DETECTION = 2  # Lane detection on every reduced_row_step-th row of the cut image only
+REUSE_SPLINES = 3  # Skip lane detection and reuse the previous splines
+LEVEL_NAMES = ('nominal', 'degraded_waypoints', 'reduced_row_detection', 'reuse_splines')
+
+logger = logging.getLogger(__name__)
+
+
+class DegradationScheduler:
+    '''
+    Per-frame time budget for the lane detection, waypoint prediction and control chain.
+    After a frame over budget the pipeline steps down one degradation level, and after
+    recovery_frames consecutive frames well within the budget it steps up one level again.
+    Within a frame, planning also degrades if lane detection has already used up most of
+    the budget. Every level change is logged and stored in events.
+
+    functions:
+        degrade_planning()
+        row_step()
+        reuse_splines()
+        update()
+        summary()
+
+    init:
+        budget: Time budget per frame in seconds (default=0.02)
+        planning_reserve: Fraction of the budget after which planning degrades within a frame (default=0.5)
+        recovery_frames: Consecutive frames below recovery_fraction of the budget before stepping up (default=50)
+        recovery_fraction: (default=0.5)
+        max_reused_frames: Consecutive frames that may reuse the previous splines (default=1)
+        max_level: Lowest allowed level (default=REUSE_SPLINES)
+        degraded_way_type: Waypoint type of the degraded levels, "fast" or "center" (default="fast")
+        reduced_row_step: row_step of the lane detection from REDUCED_ROW_DETECTION on (default=2)
+    '''
+
+    def __init__(self, budget=0.02, planning_reserve=0.5, recovery_frames=50, recovery_fraction=0.5,
+                 max_reused_frames=1, max_level=REUSE_SPLINES, degraded_way_type="fast", reduced_row_step=2):
+        self.budget = budget
+        self.planning_reserve = planning_reserve
+        self.recovery_frames = recovery_frames
+        self.recovery_fraction = recovery_fraction
+        self.max_reused_frames = max_reused_frames
+        self.max_level = max_level
+        self.degraded_way_type = degraded_way_type
+        self.reduced_row_step = reduced_row_step
+
+        self.level = NOMINAL
+        self.num_frames = 0
+        self.num_over_budget = 0
+        self.num_degraded_planning = 0
+        self.frames_per_level = [0] * len(LEVEL_NAMES)
+        self.events = []
+        self.num_recovering_frames = 0
+        self.num_reused_frames = 0
+
+    def degrade_planning(self, elapsed):
+        '''
+        Whether this frame should use degraded waypoints, given the time already spent on it.
+        '''
+        degrade = self.level >= DEGRADED_WAYPOINTS or elapsed > self.planning_reserve * self.budget
+        self.num_degraded_planning += degrade
+        return degrade
+
+    def row_step(self, nominal_row_step=1):
+        '''
+        Row step of the lane detection of this frame.
+        '''
+        return max(self.reduced_row_step, nominal_row_step) if self.level >= REDUCED_ROW_DETECTION else nominal_row_step
+
+    def reuse_splines(self):
+        '''
+        Whether this frame should skip lane detection and reuse the previous splines.
+        Splines are reused for at most max_reused_frames frames in a row.
+        '''
+        if self.level >= REUSE_SPLINES and self.num_reused_frames < self.max_reused_frames:
+            self.num_reused_frames += 1
+            return True
+        self.num_reused_frames = 0
+        return False
+
+    def update(self, latency):
+        '''
+        Chooses the level of the next frame from the latency of the finished frame.
+
+        Args:
+            latency (float): Duration of the frame in seconds.
+
+        Returns:
+            int: Level of the next frame.
+        '''
+        self.num_frames += 1
+        self.frames_per_level[self.level] += 1
+
+        if latency > self.budget:
+            self.num_over_budget += 1
+            self.num_recovering_frames = 0
+            if self.level < self.max_level:
+                self.change_level(self.level + 1, "over budget", latency)
+        elif latency < self.recovery_fraction * self.budget:
+            self.num_recovering_frames += 1
+            if self.level > NOMINAL and self.num_recovering_frames >= self.recovery_frames:
+                self.num_recovering_frames = 0
+                self.change_level(self.level - 1, "recovered", latency)
+        else:
+            self.num_recovering_frames = 0
+        return self.level
+
+    def change_level(self, level, reason, latency):
+        event = {'frame': self.num_frames, 'from': LEVEL_NAMES[self.level], 'to': LEVEL_NAMES[level],
+                 'reason': reason, 'latency': latency}
+        self.events.append(event)
+        logger.info("frame %d: %s -> %s (%s, %.2f ms of %.2f ms)", event['frame'], event['from'], event['to'],
+                    reason, latency * 1e3, self.budget * 1e3)
+        self.level = level
+
+    def summary(self):
+        '''
+        Returns:
+            dict: frames, frames over budget, frames with degraded planning, frames per level and number of level changes
+        '''
+        return {'frames': self.num_frames, 'over_budget': self.num_over_budget,
+                'degraded_planning': self.num_degraded_planning,
+                'frames_per_level': dict(zip(LEVEL_NAMES, self.frames_per_level)),
+                'level_changes': len(self.events)}
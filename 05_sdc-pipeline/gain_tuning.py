@@ -0,0 +1,277 @@
+import os
+import json
+import argparse
+import itertools
+import multiprocessing as mp
+
+import numpy as np
+
+from lateral_control import LateralControllerBank
+from longitudinal_control import LongitudinalControllerBank
+from waypoint_prediction import target_speed_prediction_batch
+from vehicle_simulation import VehicleSimulator, generate_track
+
+# Searched controller parameters and their (low, high) bounds
+PARAMETER_BOUNDS = {
+    'gain_constant': (0.005, 5.0),
+    'damping_constant': (0.0, 0.9),
+    'KP': (0.005, 1.0),
+    'KI': (0.0, 0.05),
+    'KD': (0.0, 0.5),
+    'integral_windup_limit': (1.0, 50.0),
+}
+LATERAL_PARAMETERS = ('gain_constant', 'damping_constant')
+LONGITUDINAL_PARAMETERS = ('KP', 'KI', 'KD', 'integral_windup_limit')
+
+
+def simulate_closed_loop(params, tracks, num_steps=1500, max_speed=30, min_speed=15):
+    '''
+    Drives every track with one vehicle controlled by the Stanley and PID controllers,
+    with target speeds from target_speed_prediction. All tracks are simulated together
+    with a VehicleSimulator and controller banks.
+
+    args:
+        params: dict of LateralController and LongitudinalController parameters
+        tracks: list of [2, num_points] center lines from generate_track
+        num_steps: Number of simulated steps of DT seconds (default=1500)
+
+    output:
+        list of metrics per track: dict with cross_track_error (mean absolute, m),
+        speed_error (RMS, m/s), steering_rate (mean absolute change of the steering
+        action per step), distance (m) and off_track (bool)
+    '''
+    simulator = VehicleSimulator(tracks)
+    num_vehicles = simulator.num_vehicles
+    LatC_bank = LateralControllerBank(num_vehicles, **{name: params[name] for name in LATERAL_PARAMETERS if name in params})
+    LongC_bank = LongitudinalControllerBank(num_vehicles, **{name: params[name] for name in LONGITUDINAL_PARAMETERS if name in params})
+
+    waypoints, speed = simulator.reset()
+    steering = np.zeros(num_vehicles)
+    cross_track_error_sum = np.zeros(num_vehicles)
+    squared_speed_error_sum = np.zeros(num_vehicles)
+    steering_change_sum = np.zeros(num_vehicles)
+    num_recorded = np.zeros(num_vehicles)
+    was_off_track = np.zeros(num_vehicles, dtype=bool)
+
+    for _ in range(num_steps):
+        # The step that leaves the track still counts, steps after it or past the track end do not
+        recorded = ~simulator.finished & ~was_off_track
+        if not recorded.any():
+            break
+        target_speed = target_speed_prediction_batch(waypoints, max_speed=max_speed, min_speed=min_speed)
+        new_steering = LatC_bank.stanley(waypoints, speed)
+        gas, brake = LongC_bank.control(speed, target_speed)
+
+        cross_track_error_sum += np.where(recorded, simulator.cross_track_error, 0)
+        squared_speed_error_sum += np.where(recorded, (speed - target_speed) ** 2, 0)
+        steering_change_sum += np.where(recorded, np.abs(new_steering - steering), 0)
+        num_recorded += recorded
+        steering = new_steering
+
+        was_off_track = simulator.off_track.copy()
+        waypoints, speed = simulator.step(steering, gas, brake)
+
+    num_recorded = np.maximum(num_recorded, 1)
+    return [{
+        'cross_track_error': float(cross_track_error_sum[i] / num_recorded[i]),
+        'speed_error': float(np.sqrt(squared_speed_error_sum[i] / num_recorded[i])),
+        'steering_rate': float(steering_change_sum[i] / num_recorded[i]),
+        'distance': float(simulator.nearest[i] * simulator.track_spacing),
+        'off_track': bool(simulator.off_track[i]),
+    } for i in range(num_vehicles)]
+
+
+def score_metrics(metrics, weights):
+    '''
+    Weighted cost of simulation metrics, lower is better. Leaving the track adds a
+    penalty that decreases with the distance driven before.
+    '''
+    cost = (weights['cross_track_error'] * metrics['cross_track_error']
+            + weights['speed_error'] * metrics['speed_error']
+            + weights['steering_rate'] * metrics['steering_rate'])
+    if metrics['off_track']:
+        cost += weights['off_track'] * (1 + 1000 / (1 + metrics['distance']))
+    return cost
+
+
+def evaluate_candidate(task):
+    '''
+    Worker function: simulates one parameter set on all tracks.
+
+    args:
+        task: (params, track_seeds, num_steps, weights)
+
+    output:
+        (params, mean metrics over the tracks, score)
+    '''
+    params, track_seeds, num_steps, weights = task
+    runs = simulate_closed_loop(params, [generate_track(seed) for seed in track_seeds], num_steps)
+    metrics = {name: float(np.mean([run[name] for run in runs])) for name in runs[0]}
+    metrics['off_track'] = any(run['off_track'] for run in runs)
+    # Score every track separately so that one track left early is not averaged away
+    return params, metrics, float(np.mean([score_metrics(run, weights) for run in runs]))
+
+
+class GainTuner:
+    '''
+    Closed-loop tuning of the Stanley and PID controller parameters on simulated tracks.
+    Candidates are evaluated in parallel in a process pool, and every result is appended
+    to a JSON lines file, so an interrupted search can be resumed without repeating
+    evaluated candidates.
+
+    functions:
+        evaluate()
+        grid_search()
+        evolution_search()
+        best()
+
+    init:
+        results_path: JSON lines file of the results, loaded if it exists
+        num_workers: Number of worker processes (default=os.cpu_count())
+        track_seeds: Seeds of the simulated tracks (default=(0, 1, 2))
+        num_steps: Simulated steps per track (default=1500)
+        weights: Cost weights of cross_track_error, speed_error, steering_rate and off_track
+        fixed_params: Parameters not searched, e.g. the current values of the other controller
+    '''
+
+    def __init__(self, results_path, num_workers=None, track_seeds=(0, 1, 2), num_steps=1500, weights=None,
+                 fixed_params=None):
+        self.results_path = results_path
+        self.num_workers = num_workers or os.cpu_count()
+        self.track_seeds = tuple(track_seeds)
+        self.num_steps = num_steps
+        self.weights = {'cross_track_error': 1.0, 'speed_error': 0.2, 'steering_rate': 10.0, 'off_track': 100.0}
+        self.weights.update(weights or {})
+        self.fixed_params = dict(fixed_params or {})
+
+        # Settings that change the score, results stored with other settings are not reused
+        self.settings = {'track_seeds': list(self.track_seeds), 'num_steps': num_steps, 'weights': self.weights}
+
+        # Results by candidate key, loaded from earlier runs
+        self.results = {}
+        if os.path.exists(results_path):
+            with open(results_path) as f:
+                for line in f:
+                    if line.strip():
+                        result = json.loads(line)
+                        if result['settings'] == self.settings:
+                            self.results[self.key(result['params'])] = result
+
+    def key(self, params):
+        return json.dumps(sorted((name, round(value, 9)) for name, value in params.items()))
+
+    def evaluate(self, candidates):
+        '''
+        Evaluates the parameter sets that have no stored result yet.
+
+        args:
+            candidates: list of dicts of searched parameters
+
+        output:
+            list of result dicts (params, metrics, score) in the order of the candidates
+        '''
+        candidates = [{**self.fixed_params, **{name: float(value) for name, value in params.items()}}
+                      for params in candidates]
+        missing = list({self.key(params): params for params in candidates
+                        if self.key(params) not in self.results}.values())
+        if missing:
+            tasks = [(params, self.track_seeds, self.num_steps, self.weights) for params in missing]
+            with mp.Pool(self.num_workers) as pool, open(self.results_path, 'a') as f:
+                for params, metrics, score in pool.imap_unordered(evaluate_candidate, tasks):
+                    result = {'params': params, 'metrics': metrics, 'score': score, 'settings': self.settings}
+                    self.results[self.key(params)] = result
+                    f.write(json.dumps(result) + '\n')
+                    f.flush()
+        return [self.results[self.key(params)] for params in candidates]
+
+    def grid_search(self, grid):
+        '''
+        Evaluates every combination of the given parameter values.
+
+        args:
+            grid: dict of parameter name to list of values
+        '''
+        names = list(grid)
+        return self.evaluate([dict(zip(names, values)) for values in itertools.product(*grid.values())])
+
+    def evolution_search(self, names, initial_params=None, num_generations=20, population_size=16, seed=0, sigma=0.3):
+        '''
+        CMA-style evolution strategy with a diagonal covariance. Parameters are searched
+        in their PARAMETER_BOUNDS normalized to [0, 1]. The search is deterministic for a
+        seed, so a resumed search reuses the stored results of the finished generations.
+
+        args:
+            names: Searched parameter names
+            initial_params: dict of start values, the middle of the bounds where not given (default=None)
+            num_generations: (default=20)
+            population_size: Candidates per generation (default=16)
+            seed: Random seed (default=0)
+            sigma: Initial step size in normalized units (default=0.3)
+        '''
+        rng = np.random.default_rng(seed)
+        low, high = np.array([PARAMETER_BOUNDS[name] for name in names]).T
+        to_params = lambda z: dict(zip(names, (low + np.clip(z, 0, 1) * (high - low)).tolist()))
+
+        initial_params = initial_params or {}
+        mean = np.array([(initial_params[name] - low[i]) / (high[i] - low[i]) if name in initial_params else 0.5
+                         for i, name in enumerate(names)])
+        std = np.full(len(names), sigma)
+        num_parents = population_size // 2
+        recombination_weights = np.log(num_parents + 0.5) - np.log(np.arange(1, num_parents + 1))
+        recombination_weights /= recombination_weights.sum()
+
+        for _ in range(num_generations):
+            samples = np.clip(mean + std * rng.standard_normal((population_size, len(names))), 0, 1)
+            results = self.evaluate([to_params(z) for z in samples])
+            order = np.argsort([result['score'] for result in results])
+            parents = samples[order[:num_parents]]
+
+            # Move the mean towards the best candidates and adapt the spread per parameter
+            new_mean = recombination_weights @ parents
+            spread = np.sqrt(recombination_weights @ (parents - mean) ** 2)
+            std = np.clip(0.7 * std + 0.3 * spread, 1e-3, 0.5)
+            mean = new_mean
+        return self.best()
+
+    def best(self):
+        '''Stored result with the lowest score.'''
+        return min(self.results.values(), key=lambda result: result['score']) if self.results else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Parallel closed-loop tuning of the Stanley and PID controller gains")
+    parser.add_argument('--results', type=str, default='gain_tuning_results.jsonl', help='resumable result file')
+    parser.add_argument('--method', type=str, default='evolution', choices=['grid', 'evolution'])
+    parser.add_argument('--controller', type=str, default='both', choices=['lateral', 'longitudinal', 'both'])
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--tracks', type=int, default=3, help='number of simulated tracks')
+    parser.add_argument('--steps', type=int, default=1500, help='simulated steps per track')
+    parser.add_argument('--grid_size', type=int, default=5, help='values per parameter of the grid search')
+    parser.add_argument('--generations', type=int, default=20)
+    parser.add_argument('--population', type=int, default=16)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    names = {'lateral': LATERAL_PARAMETERS, 'longitudinal': LONGITUDINAL_PARAMETERS,
+             'both': LATERAL_PARAMETERS + LONGITUDINAL_PARAMETERS}[args.controller]
+    # The parameters that are not searched keep the defaults of the controllers
+    defaults = {'gain_constant': 0.025, 'damping_constant': 0.0125,
+                'KP': 0.01, 'KI': 0.0, 'KD': 0.0, 'integral_windup_limit': 10}
+    tuner = GainTuner(args.results, args.workers, range(args.tracks), args.steps,
+                      fixed_params={name: value for name, value in defaults.items() if name not in names})
+
+    baseline = tuner.evaluate([{name: defaults[name] for name in names}])[0]
+    print("default parameters: score {:.3f} {}".format(baseline['score'], baseline['metrics']))
+
+    if args.method == 'grid':
+        tuner.grid_search({name: np.linspace(*PARAMETER_BOUNDS[name], args.grid_size).tolist() for name in names})
+    else:
+        tuner.evolution_search(names, defaults, args.generations, args.population, args.seed)
+
+    best = tuner.best()
+    print("best parameters: score {:.3f} {}".format(best['score'], best['metrics']))
+    print(best['params'])
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,7 @@
 import numpy as np
 
+from tracing import traced
+
 class LateralController:
     '''
     Lateral control using the Stanley controller
@@ -17,6 +19,7 @@ class LateralController:
         self.damping_constant = damping_constant
         self.previous_steering_angle = 0
 
+    @traced("lateral_control.stanley")
     def stanley(self, waypoints, speed):
         '''
         One step of the Stanley controller with damping.
@@ -65,3 +68,66 @@ class LateralController:
         steering_angle = delta
         # Clip to the maximum steering angle (0.4 radians) and rescale the steering action space
         return np.clip(steering_angle, -0.4, 0.4) / 0.4
+
+
+class LateralControllerBank:
+    '''
+    Stanley controllers of several vehicles, updated together in one vectorized call.
+    Gives the same steering as a LateralController per vehicle.
+
+    functions:
+        stanley
+        reset
+
+    init:
+        num_vehicles
+        gain_constant: scalar or one gain per vehicle (default=0.025)
+        damping_constant: scalar or one damping per vehicle (default=0.0125)
+    '''
+
+    def __init__(self, num_vehicles, gain_constant=0.025, damping_constant=0.0125):
+        self.num_vehicles = num_vehicles
+        self.gain_constant = np.broadcast_to(np.asarray(gain_constant, dtype=np.float64), (num_vehicles,)).copy()
+        self.damping_constant = np.broadcast_to(np.asarray(damping_constant, dtype=np.float64), (num_vehicles,)).copy()
+        self.previous_steering_angle = np.zeros(num_vehicles)
+
+    def reset(self, vehicles=None):
+        '''
+        Resets the damping state of the given vehicles (default: all).
+        '''
+        if vehicles is None:
+            self.previous_steering_angle[:] = 0
+        else:
+            self.previous_steering_angle[vehicles] = 0
+
+    @traced("lateral_control.stanley_bank")
+    def stanley(self, waypoints, speed):
+        '''
+        One step of the Stanley controller with damping for all vehicles.
+        Args:
+            waypoints (np.array): Shape [num_vehicles, 2, num_waypoints], the waypoints in vehicle coordinates.
+            speed (np.array): Shape [num_vehicles], the current speeds of the vehicles.
+
+        Returns:
+            np.array: Shape [num_vehicles], steering actions in [-1, 1].
+        '''
+        epsilon = 1e-6
+
+        # Orientation error as the angle of the first path segment to the car orientation (along the x-axis)
+        if waypoints.shape[2] >= 2:
+            psi_t = np.arctan2(waypoints[:, 1, 1] - waypoints[:, 1, 0], waypoints[:, 0, 1] - waypoints[:, 0, 0])
+        else:
+            psi_t = np.zeros(self.num_vehicles)
+        psi_t = (psi_t + np.pi) % (2 * np.pi) - np.pi
+
+        # Signed cross-track error between the first waypoint and the car position at the origin
+        dx_error = waypoints[:, 0, 0]
+        dy_error = waypoints[:, 1, 0]
+        d_t = np.hypot(dx_error, dy_error) * np.sign(dy_error)
+
+        # Stanley control law and damping
+        delta_sc = psi_t + np.arctan2(self.gain_constant * d_t, np.asarray(speed) + epsilon)
+        delta = delta_sc - self.damping_constant * (delta_sc - self.previous_steering_angle)
+        self.previous_steering_angle = delta
+
+        return np.clip(delta, -0.4, 0.4) / 0.4
@@ -1,10 +1,13 @@
 import numpy as np
-import matplotlib.pyplot as plt
 from scipy.signal import find_peaks
 from scipy.interpolate import splprep, splev
 from scipy.optimize import minimize
 import time
 
+from visualization import SpeedPlot
+from tracing import traced
+from telemetry import TelemetryBuffer
+
 class LongitudinalController:
     '''
     Longitudinal Control using a PID Controller
@@ -12,14 +15,21 @@ class LongitudinalController:
     functions:
         PID_step()
         control()
+        plot_speed()
+
+    init:
+        KP, KI, KD (default=0.01, 0.0, 0.0)
+        integral_windup_limit (default=10)
+        history_capacity: Number of samples kept for plot_speed (default=2000)
+        history_decimation: Keep every history_decimation-th sample of plot_speed (default=1)
     '''
-    def __init__(self, KP=0.01, KI=0.0, KD=0.0, integral_windup_limit=10):
+    def __init__(self, KP=0.01, KI=0.0, KD=0.0, integral_windup_limit=10, history_capacity=2000, history_decimation=1):
         self.last_error = 0
         self.sum_error = 0
         self.last_control = 0
-        self.speed_history = []
-        self.target_speed_history = []
-        self.step_history = [] 
+        # Bounded speed history of plot_speed
+        self.telemetry = TelemetryBuffer(("step", "speed", "target_speed"), history_capacity, history_decimation)
+        self.speed_plot = None
 
         # PID parameters
         self.KP = KP
@@ -65,6 +75,7 @@ class LongitudinalController:
 
         return control
 
+    @traced("longitudinal_control.control")
     def control(self, speed, target_speed):
         '''
         Derive action values for gas and brake via the control signal
@@ -92,14 +103,103 @@ class LongitudinalController:
 
         return gas, brake
 
+    @property
+    def speed_history(self):
+        return self.telemetry.snapshot()["speed"]
+
+    @property
+    def target_speed_history(self):
+        return self.telemetry.snapshot()["target_speed"]
+
+    @property
+    def step_history(self):
+        return self.telemetry.snapshot()["step"]
+
     def plot_speed(self, speed, target_speed, step, fig):
         '''
         Plot the speed history and target speed history for visualization.
+        The plot is created on the first call for a figure and afterwards only
+        updated and redrawn with blitting. Only the last history_capacity stored
+        samples are shown, so the cost per call stays constant.
+        '''
+        if not self.telemetry.append(step, speed, target_speed):
+            return
+        if self.speed_plot is None or self.speed_plot.fig is not fig:
+            self.speed_plot = SpeedPlot(fig)
+        history = self.telemetry.snapshot()
+        self.speed_plot.update(history["step"], history["speed"], history["target_speed"])
+
+
+class LongitudinalControllerBank:
+    '''
+    PID controllers of several vehicles, updated together in one vectorized call.
+    Gives the same actions as a LongitudinalController per vehicle.
+
+    functions:
+        PID_step()
+        control()
+        reset()
+
+    init:
+        num_vehicles
+        KP, KI, KD, integral_windup_limit: scalars or one value per vehicle
+    '''
+    def __init__(self, num_vehicles, KP=0.01, KI=0.0, KD=0.0, integral_windup_limit=10):
+        self.num_vehicles = num_vehicles
+        per_vehicle = lambda value: np.broadcast_to(np.asarray(value, dtype=np.float64), (num_vehicles,)).copy()
+        self.KP = per_vehicle(KP)
+        self.KI = per_vehicle(KI)
+        self.KD = per_vehicle(KD)
+        self.integral_windup_limit = per_vehicle(integral_windup_limit)
+
+        self.last_error = np.zeros(num_vehicles)
+        self.sum_error = np.zeros(num_vehicles)
+
+    def reset(self, vehicles=None):
         '''
-        self.speed_history.append(speed)
-        self.target_speed_history.append(target_speed)
-        self.step_history.append(step)
-        plt.gcf().clear()
-        plt.plot(self.step_history, self.speed_history, c="green")
-        plt.plot(self.step_history, self.target_speed_history)
-        fig.canvas.flush_events()
+        Resets the PID state of the given vehicles (default: all).
+        '''
+        if vehicles is None:
+            vehicles = slice(None)
+        self.last_error[vehicles] = 0
+        self.sum_error[vehicles] = 0
+
+    def PID_step(self, speed, target_speed, dt=1.0):
+        '''
+        One step of the PID control for all vehicles.
+
+        args:
+            speed: [num_vehicles] current vehicle speeds
+            target_speed: [num_vehicles] desired target speeds
+            dt: time step (default = 1.0)
+
+        output:
+            control: [num_vehicles] control signals
+        '''
+        error = np.asarray(target_speed, dtype=np.float64) - speed
+
+        P_term = self.KP * error
+        self.sum_error = np.clip(self.sum_error + error * dt, -self.integral_windup_limit, self.integral_windup_limit)
+        I_term = self.KI * self.sum_error
+        D_term = self.KD * (error - self.last_error) / dt
+        self.last_error = error
+
+        return P_term + I_term + D_term
+
+    @traced("longitudinal_control.control_bank")
+    def control(self, speed, target_speed):
+        '''
+        Derive gas and brake values of all vehicles via PID controlling.
+
+        Args:
+            speed (np.array): [num_vehicles] current speeds
+            target_speed (np.array): [num_vehicles] desired target speeds
+
+        output:
+            gas (np.array): [num_vehicles] throttle values between 0 and 0.8
+            brake (np.array): [num_vehicles] brake values between 0 and 0.8
+        '''
+        control = self.PID_step(speed, target_speed)
+        gas = np.where(control >= 0, np.clip(control, 0, 0.8), 0.0)
+        brake = np.where(control >= 0, 0.0, np.clip(-1 * control, 0, 0.8))
+        return gas, brake
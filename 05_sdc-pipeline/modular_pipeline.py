@@ -0,0 +1,273 @@
+import time
+import queue
+import threading
+
+import numpy as np
+
+from lane_detection import LaneDetection
+from waypoint_prediction import WaypointPlanner, target_speed_prediction
+from lateral_control import LateralController
+from longitudinal_control import LongitudinalController
+
+STAGES = ('lane_detection', 'waypoint_prediction', 'target_speed_prediction', 'lateral_control',
+          'longitudinal_control', 'total')
+
+
+class ModularPipeline:
+    '''
+    Lane detection, waypoint and target speed prediction, Stanley and PID control
+    as one reusable step function without any plotting or environment code. The
+    pipeline owns the state of all modules and returns the same action array
+    every step, overwritten in place.
+
+    If no lane boundaries have been detected yet, the previous action is kept.
+    With a DegradationScheduler, cheaper variants of the stages are used while
+    frames exceed its time budget.
+
+    functions:
+        step()
+        reset()
+        timing_summary()
+
+    init:
+        LD_module: LaneDetection (default=LaneDetection())
+        planner: WaypointPlanner (default=WaypointPlanner())
+        LatC_module: LateralController (default=LateralController())
+        LongC_module: LongitudinalController (default=LongitudinalController())
+        longitudinal_control: False keeps gas and brake at zero like test_lateral_control.py (default=True)
+        target_speed_kwargs: Keyword arguments of target_speed_prediction (default=None)
+        default_speed: Speed used if neither step() nor info provide one (default=0.0)
+        scheduler: DegradationScheduler, None always runs the nominal stages (default=None)
+    '''
+
+    def __init__(self, LD_module=None, planner=None, LatC_module=None, LongC_module=None, longitudinal_control=True,
+                 target_speed_kwargs=None, default_speed=0.0, scheduler=None):
+        self.LD_module = LD_module if LD_module is not None else LaneDetection()
+        self.planner = planner if planner is not None else WaypointPlanner()
+        self.LatC_module = LatC_module if LatC_module is not None else LateralController()
+        self.LongC_module = LongC_module if LongC_module is not None else LongitudinalController()
+        self.longitudinal_control = longitudinal_control
+        self.target_speed_kwargs = dict(target_speed_kwargs or {})
+        self.default_speed = default_speed
+        self.scheduler = scheduler
+        # Configured modes, restored whenever the scheduler is back at the nominal level
+        self.row_step = self.LD_module.row_step
+        self.way_type = self.planner.way_type
+
+        # Action variables: [steering, gas, brake], reused every step
+        self.action = np.zeros(3)
+
+        # Results of the last step
+        self.lane_boundaries = (None, None)
+        self.waypoints = None
+        self.target_speed = None
+        self.speed = None
+
+        # Stage latencies of the last step and their sums in seconds, indexed like STAGES
+        self.timings = np.zeros(len(STAGES))
+        self.timing_sums = np.zeros(len(STAGES))
+        self.num_steps = 0
+
+    def reset(self):
+        '''
+        Resets the state of all modules, e.g. at the start of an episode.
+        '''
+        self.LD_module.lane_boundary1_old = None
+        self.LD_module.lane_boundary2_old = None
+        self.LD_module.is_tracking = False
+        self.planner.reset()
+        self.LatC_module.previous_steering_angle = 0
+        self.LongC_module.last_error = 0
+        self.LongC_module.sum_error = 0
+        self.action[:] = 0
+        self.lane_boundaries = (None, None)
+        self.waypoints = None
+        self.target_speed = None
+
+    def step(self, observation, info=None, speed=None):
+        '''
+        Computes the action for one observation.
+
+        Args:
+            observation (numpy.ndarray): Image of size 96 x 96 x 3.
+            info (dict): Info dictionary of the environment, its 'speed' is used if speed is not given.
+            speed (float): Current speed of the vehicle (default=None).
+
+        Returns:
+            numpy.ndarray: [steering, gas, brake], the same array every step.
+        '''
+        timings = self.timings
+        timings[:] = 0
+        start = time.perf_counter()
+
+        if speed is None:
+            speed = info.get('speed', self.default_speed) if info else self.default_speed
+        self.speed = speed
+
+        # Lane detection
+        scheduler = self.scheduler
+        if scheduler is not None and self.lane_boundaries[0] is not None and scheduler.reuse_splines():
+            lane_boundary1, lane_boundary2 = self.lane_boundaries
+        else:
+            if scheduler is not None:
+                self.LD_module.row_step = scheduler.row_step(self.row_step)
+            lane_boundary1, lane_boundary2 = self.LD_module.lane_detection(observation)
+        self.lane_boundaries = (lane_boundary1, lane_boundary2)
+        t1 = time.perf_counter()
+        timings[0] = t1 - start
+
+        if lane_boundary1 is not None and lane_boundary2 is not None:
+            # Waypoint and target_speed prediction
+            if scheduler is not None and scheduler.degrade_planning(t1 - start):
+                self.planner.way_type = scheduler.degraded_way_type
+            self.waypoints = self.planner.waypoint_prediction(lane_boundary1, lane_boundary2)
+            self.planner.way_type = self.way_type
+            t2 = time.perf_counter()
+            self.target_speed = target_speed_prediction(self.waypoints, **self.target_speed_kwargs)
+            t3 = time.perf_counter()
+
+            # Control
+            self.action[0] = self.LatC_module.stanley(self.waypoints, speed)
+            t4 = time.perf_counter()
+            if self.longitudinal_control:
+                self.action[1], self.action[2] = self.LongC_module.control(speed, self.target_speed)
+            t5 = time.perf_counter()
+            timings[1:5] = (t2 - t1, t3 - t2, t4 - t3, t5 - t4)
+
+        timings[5] = time.perf_counter() - start
+        if scheduler is not None:
+            scheduler.update(timings[5])
+        self.timing_sums += timings
+        self.num_steps += 1
+        return self.action
+
+    def timing_summary(self):
+        '''
+        Mean latency per stage over all steps.
+
+        Returns:
+            dict: stage name to mean latency in seconds
+        '''
+        return dict(zip(STAGES, (self.timing_sums / max(self.num_steps, 1)).tolist()))
+
+
+class PipelinedExecutor:
+    '''
+    Runs a ModularPipeline on a worker thread with a lag of one frame: step() hands
+    frame t to the worker and returns the action of frame t-1, so the environment
+    steps while frame t is processed. NumPy and SciPy release the GIL in much of the
+    pipeline, so the two overlap even in one process.
+
+    The lag is measured per step as the age of the returned action, the time since
+    the observation it was computed from was submitted, and as the time step() waited
+    for the worker. report() summarizes both from running sums, so memory stays constant.
+    An exception of the pipeline is raised again by the step() that collects the frame.
+
+    functions:
+        step()
+        reset()
+        report()
+        close()
+
+    init:
+        pipeline: ModularPipeline (default=ModularPipeline())
+    '''
+
+    def __init__(self, pipeline=None):
+        self.pipeline = pipeline if pipeline is not None else ModularPipeline()
+
+        # Action of the last finished frame, separate from the array the worker writes
+        self.action = np.zeros(3)
+        self.waypoints = None
+        self.target_speed = None
+
+        self.requests = queue.Queue(maxsize=1)
+        self.results = queue.Queue(maxsize=1)
+        self.pending = False
+        self.submit_time = None
+        self.num_collected = 0
+        self.action_age_sum = 0.0
+        self.action_age_max = 0.0
+        self.wait_sum = 0.0
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            request = self.requests.get()
+            if request is None:
+                break
+            try:
+                self.pipeline.step(*request)
+            except Exception as error:
+                # Handed to the main thread, the worker keeps serving requests
+                self.results.put((None, None, None, error))
+                continue
+            self.results.put((self.pipeline.action.copy(), self.pipeline.waypoints, self.pipeline.target_speed, None))
+
+    def collect(self):
+        # Waits for the frame in flight and takes over its results
+        start = time.perf_counter()
+        action, waypoints, target_speed, error = self.results.get()
+        now = time.perf_counter()
+        self.pending = False
+        if error is not None:
+            raise error
+        self.action[:] = action
+        self.waypoints, self.target_speed = waypoints, target_speed
+        self.num_collected += 1
+        self.wait_sum += now - start
+        self.action_age_sum += now - self.submit_time
+        self.action_age_max = max(self.action_age_max, now - self.submit_time)
+
+    def step(self, observation, info=None, speed=None):
+        '''
+        Submits an observation and returns the action of the previous one.
+
+        Args:
+            observation (numpy.ndarray): Image of size 96 x 96 x 3, copied before it is submitted.
+            info (dict): Info dictionary of the environment.
+            speed (float): Current speed of the vehicle (default=None).
+
+        Returns:
+            numpy.ndarray: [steering, gas, brake] of the previous frame, zeros at the first step. The same array every step.
+        '''
+        if self.pending:
+            self.collect()
+        self.submit_time = time.perf_counter()
+        self.requests.put((np.array(observation), dict(info) if info else None, speed))
+        self.pending = True
+        return self.action
+
+    def reset(self):
+        '''
+        Drops the frame in flight and resets the pipeline, e.g. at the start of an episode.
+        '''
+        if self.pending:
+            self.results.get()
+            self.pending = False
+        self.pipeline.reset()
+        self.action[:] = 0
+        self.waypoints = None
+        self.target_speed = None
+
+    def report(self):
+        '''
+        Lag introduced by the pipelining.
+
+        Returns:
+            dict: lag in frames, mean and maximum age of the returned actions and mean time waited for the worker in seconds
+        '''
+        num_collected = max(self.num_collected, 1)
+        return {'lag_frames': 1, 'mean_action_age': self.action_age_sum / num_collected,
+                'max_action_age': self.action_age_max, 'mean_wait': self.wait_sum / num_collected,
+                'steps': self.num_collected}
+
+    def close(self):
+        '''Finishes the frame in flight and stops the worker thread, also if the frame failed.'''
+        try:
+            if self.pending:
+                self.collect()
+        finally:
+            self.requests.put(None)
+            self.thread.join()
@@ -0,0 +1,223 @@
+import queue
+import multiprocessing as mp
+from collections import deque
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from lane_detection import LaneDetection
+
+FRAME_SHAPE = (96, 96, 3)
+
+
+def perception_worker(shm_name, capacity, task_queue, released_slots, result_queue, lane_detection_kwargs):
+    '''
+    Worker process: copies frames out of the shared ring buffer, releases their slots
+    and runs the lane detection on them. An exception of the lane detection is sent
+    back as the result of its frame, and the worker keeps serving tasks.
+
+    args:
+        shm_name: Name of the shared memory block holding the ring buffer
+        capacity: Number of frame slots in the ring buffer
+        task_queue: Queue of (sequence number, slot) tasks, None stops the worker
+        released_slots: Queue the slots are returned to once their frame is copied
+        result_queue: Queue receiving (sequence number, lane_boundary1, lane_boundary2, error)
+        lane_detection_kwargs: Keyword arguments of LaneDetection
+    '''
+    shm = shared_memory.SharedMemory(name=shm_name)
+    frames = np.ndarray((capacity,) + FRAME_SHAPE, dtype=np.uint8, buffer=shm.buf)
+    LD_module = LaneDetection(**lane_detection_kwargs)
+    frame = np.empty(FRAME_SHAPE, dtype=np.uint8)
+    try:
+        while True:
+            task = task_queue.get()
+            if task is None:
+                break
+            seq, slot = task
+            frame[:] = frames[slot]
+            released_slots.put(slot)
+
+            # Frames are spread over the workers, so the fallback to the previous
+            # splines is resolved in frame order by the server
+            LD_module.lane_boundary1_old = None
+            LD_module.lane_boundary2_old = None
+            try:
+                lane_boundary1, lane_boundary2 = LD_module.lane_detection(frame)
+            except Exception as error:
+                result_queue.put((seq, None, None, error))
+                continue
+            result_queue.put((seq, lane_boundary1, lane_boundary2, None))
+    finally:
+        del frames
+        shm.close()
+
+
+class PerceptionServer:
+    '''
+    Runs LaneDetection in a pool of worker processes fed through a shared memory
+    ring buffer of 96x96x3 frames, so the control loop never blocks on perception.
+
+    Frames get consecutive sequence numbers. If all slots are in use, submit drops
+    the frame instead of waiting. Results are returned in frame order, dropped
+    frames are skipped, and a frame without detected lanes reuses the splines of
+    the previous returned frame like LaneDetection.lane_detection does.
+
+    The free slots are kept in the server process and refilled from the slots the
+    workers release, so a slot is never lost to a queue that has not been flushed yet.
+    An exception of the lane detection of a frame is raised again by the poll() that
+    reaches the frame, and submit() and poll() raise a RuntimeError once a worker
+    process has died.
+
+    functions:
+        submit()
+        poll()
+        close()
+
+    init:
+        num_workers (default=2)
+        capacity: Number of frame slots in the ring buffer (default=16)
+        lane_detection_kwargs: Keyword arguments of LaneDetection (default=None)
+    '''
+
+    def __init__(self, num_workers=2, capacity=16, lane_detection_kwargs=None):
+        lane_detection_kwargs = dict(lane_detection_kwargs or {})
+        # The workers see frames out of order, so there is no previous frame to track
+        lane_detection_kwargs['tracking'] = False
+
+        self.capacity = capacity
+        self.shm = shared_memory.SharedMemory(create=True, size=capacity * int(np.prod(FRAME_SHAPE)))
+        self.frames = np.ndarray((capacity,) + FRAME_SHAPE, dtype=np.uint8, buffer=self.shm.buf)
+
+        self.task_queue = mp.Queue()
+        self.released_slots = mp.Queue()
+        self.result_queue = mp.Queue()
+        self.free_slots = deque(range(capacity))
+
+        self.workers = [
+            mp.Process(target=perception_worker,
+                       args=(self.shm.name, capacity, self.task_queue, self.released_slots,
+                             self.result_queue, lane_detection_kwargs),
+                       daemon=True)
+            for _ in range(num_workers)
+        ]
+        for worker in self.workers:
+            worker.start()
+
+        # Sequence numbers and in-order delivery
+        self.next_seq = 0
+        self.next_result_seq = 0
+        self.pending_results = {}
+        self.dropped_seqs = set()
+        self.num_submitted = 0
+        self.num_dropped = 0
+        self.lane_boundary1_old = None
+        self.lane_boundary2_old = None
+
+    def submit(self, frame):
+        '''
+        Copies a frame into a free slot of the ring buffer and queues it for detection.
+        Never blocks: if no slot is free, the frame is dropped.
+
+        Args:
+            frame (numpy.ndarray): Image of size 96 x 96 x 3.
+
+        Returns:
+            tuple: (sequence number, accepted)
+        '''
+        self.check_workers()
+        self.drain_released_slots()
+        seq = self.next_seq
+        self.next_seq += 1
+        if not self.free_slots:
+            self.dropped_seqs.add(seq)
+            self.num_dropped += 1
+            return seq, False
+        slot = self.free_slots.popleft()
+        self.frames[slot] = frame
+        self.task_queue.put((seq, slot))
+        self.num_submitted += 1
+        return seq, True
+
+    def poll(self, timeout=0.0):
+        '''
+        Collects finished detections and returns those that are next in frame order.
+        If the lane detection of the next frame raised, the exception is raised again,
+        after the results before it have been returned.
+
+        Args:
+            timeout (float): Seconds to wait for the first result, 0 does not block (default=0).
+
+        Returns:
+            list: (sequence number, lane_boundary1, lane_boundary2) tuples in frame order
+        '''
+        self.check_workers()
+        self.drain_released_slots()
+        block = timeout > 0
+        while True:
+            try:
+                seq, lane_boundary1, lane_boundary2, error = self.result_queue.get(
+                    block=block, timeout=timeout if block else None)
+            except queue.Empty:
+                break
+            self.pending_results[seq] = (lane_boundary1, lane_boundary2, error)
+            block = False
+
+        results = []
+        while self.next_result_seq < self.next_seq:
+            seq = self.next_result_seq
+            if seq in self.dropped_seqs:
+                self.dropped_seqs.discard(seq)
+            elif seq in self.pending_results:
+                if self.pending_results[seq][2] is not None:
+                    if results:
+                        break
+                    self.next_result_seq += 1
+                    raise self.pending_results.pop(seq)[2]
+                lane_boundary1, lane_boundary2, _ = self.pending_results.pop(seq)
+                if lane_boundary1 is None or lane_boundary2 is None:
+                    lane_boundary1, lane_boundary2 = self.lane_boundary1_old, self.lane_boundary2_old
+                self.lane_boundary1_old, self.lane_boundary2_old = lane_boundary1, lane_boundary2
+                results.append((seq, lane_boundary1, lane_boundary2))
+            else:
+                break
+            self.next_result_seq += 1
+        return results
+
+    def drain_released_slots(self):
+        '''Moves the slots released by the workers back to the free slots.'''
+        while True:
+            try:
+                self.free_slots.append(self.released_slots.get_nowait())
+            except queue.Empty:
+                break
+
+    def check_workers(self):
+        '''Raises a RuntimeError if a worker process has died.'''
+        for worker in self.workers:
+            if not worker.is_alive():
+                raise RuntimeError("perception worker {} exited with code {}".format(worker.pid, worker.exitcode))
+
+    def num_in_flight(self):
+        '''Number of accepted frames whose result has not been returned by poll yet.'''
+        num_returned = self.next_result_seq - (self.num_dropped - len(self.dropped_seqs))
+        return self.num_submitted - num_returned
+
+    def close(self):
+        '''Stops the workers and releases the shared memory.'''
+        for _ in self.workers:
+            self.task_queue.put(None)
+        for worker in self.workers:
+            # A worker killed inside task_queue.get() keeps its lock, so the others may never see the stop task
+            worker.join(timeout=1.0)
+            if worker.is_alive():
+                worker.terminate()
+                worker.join()
+        del self.frames
+        self.shm.close()
+        self.shm.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
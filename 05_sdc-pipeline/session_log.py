@@ -0,0 +1,219 @@
+import os
+import json
+import time
+import argparse
+
+import numpy as np
+
+FRAME_SHAPE = (96, 96, 3)
+# Numeric values stored per step besides the observation
+COLUMNS = ('steering', 'gas', 'brake', 'reward', 'speed', 'terminated', 'truncated')
+
+
+class SessionRecorder:
+    '''
+    Streams the steps of a driving session into a log directory. Observations are
+    written to memory-mapped uint8 .npy chunks of chunk_size frames, the actions,
+    rewards and speeds to float64 chunks of the same length, and the info dictionaries
+    to a JSON lines file. Only the current chunk is mapped, so memory stays constant
+    for sessions of any length. A step is the action passed to env.step together with
+    the observation, reward and info it returned. The metadata is written at the start
+    and updated with every new chunk, so the completed chunks of a session that never
+    reached close() stay readable.
+
+    functions:
+        record()
+        close()
+
+    init:
+        directory: Log directory, created if it does not exist
+        chunk_size: Frames per chunk file (default=1024)
+        frame_shape: (default=(96, 96, 3))
+    '''
+
+    def __init__(self, directory, chunk_size=1024, frame_shape=FRAME_SHAPE):
+        self.directory = directory
+        self.chunk_size = chunk_size
+        self.frame_shape = tuple(frame_shape)
+        os.makedirs(directory, exist_ok=True)
+        self.info_file = open(os.path.join(directory, 'info.jsonl'), 'w')
+        self.num_steps = 0
+        self.frames = None
+        self.values = None
+        self.write_meta()
+
+    def write_meta(self):
+        with open(os.path.join(self.directory, 'meta.json'), 'w') as f:
+            json.dump({'num_steps': self.num_steps, 'chunk_size': self.chunk_size,
+                       'frame_shape': list(self.frame_shape), 'columns': list(COLUMNS)}, f)
+
+    def open_chunk(self, index):
+        self.flush()
+        self.info_file.flush()
+        self.write_meta()
+        self.frames = np.lib.format.open_memmap(os.path.join(self.directory, 'frames_{:05d}.npy'.format(index)),
+                                                mode='w+', dtype=np.uint8, shape=(self.chunk_size,) + self.frame_shape)
+        self.values = np.lib.format.open_memmap(os.path.join(self.directory, 'values_{:05d}.npy'.format(index)),
+                                                mode='w+', dtype=np.float64, shape=(self.chunk_size, len(COLUMNS)))
+
+    def flush(self):
+        if self.frames is not None:
+            self.frames.flush()
+            self.values.flush()
+
+    def record(self, observation, action, reward=0.0, info=None, speed=None, terminated=False, truncated=False):
+        '''
+        Appends one step.
+
+        Args:
+            observation (numpy.ndarray): Image of size 96 x 96 x 3 returned by env.step.
+            action (array-like): [steering, gas, brake] passed to env.step.
+            reward (float): Reward returned by env.step.
+            info (dict): Info dictionary returned by env.step, values that are not JSON serializable are stored as strings.
+            speed (float): Speed of the vehicle, taken from info if not given and NaN if unknown.
+            terminated (bool), truncated (bool): Episode end flags returned by env.step.
+        '''
+        index = self.num_steps % self.chunk_size
+        if index == 0:
+            self.open_chunk(self.num_steps // self.chunk_size)
+        info = info or {}
+        if speed is None:
+            speed = info.get('speed', np.nan)
+
+        self.frames[index] = observation
+        self.values[index, :3] = action
+        self.values[index, 3:] = (reward, speed, terminated, truncated)
+        self.info_file.write(json.dumps(info, default=str) + '\n')
+        self.num_steps += 1
+
+    def close(self):
+        '''Flushes the chunks and writes the final metadata.'''
+        self.flush()
+        self.frames = self.values = None
+        self.info_file.close()
+        self.write_meta()
+
+
+class SessionLog:
+    '''
+    Read access to a log written by SessionRecorder. The chunks are memory-mapped
+    read-only, so frames are only loaded from disk when they are used.
+
+    functions:
+        observation()
+        chunks()
+        column()
+        infos()
+
+    init:
+        directory: Log directory
+    '''
+
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, 'meta.json')) as f:
+            meta = json.load(f)
+        self.num_steps = meta['num_steps']
+        self.chunk_size = meta['chunk_size']
+        self.columns = tuple(meta['columns'])
+        num_chunks = -(-self.num_steps // self.chunk_size)
+        self.frames = [np.load(os.path.join(directory, 'frames_{:05d}.npy'.format(i)), mmap_mode='r')
+                       for i in range(num_chunks)]
+        self.values = np.concatenate([np.load(os.path.join(directory, 'values_{:05d}.npy'.format(i)))
+                                      for i in range(num_chunks)] or [np.zeros((0, len(self.columns)))])[:self.num_steps]
+
+    def __len__(self):
+        return self.num_steps
+
+    def observation(self, step):
+        return self.frames[step // self.chunk_size][step % self.chunk_size]
+
+    def chunks(self):
+        '''
+        Iterates over the observations chunk by chunk.
+
+        output:
+            (first step, [num_frames, 96, 96, 3] read-only array) per chunk
+        '''
+        for i, frames in enumerate(self.frames):
+            start = i * self.chunk_size
+            yield start, frames[:min(self.chunk_size, self.num_steps - start)]
+
+    def column(self, name):
+        '''[num_steps] values of one of COLUMNS'''
+        return self.values[:, self.columns.index(name)]
+
+    @property
+    def actions(self):
+        return self.values[:, :3]
+
+    def infos(self):
+        with open(os.path.join(self.directory, 'info.jsonl')) as f:
+            return [json.loads(line) for line in f]
+
+
+def replay(log, pipeline=None, num_steps=None):
+    '''
+    Feeds the recorded observations and speeds through a ModularPipeline without an
+    environment or display. The pipeline is reset at the start of every recorded episode.
+
+    args:
+        log: SessionLog
+        pipeline: ModularPipeline (default=ModularPipeline())
+        num_steps: Number of replayed steps (default: all)
+
+    output:
+        actions: [num_steps, 3] actions of the pipeline
+        duration: Total duration of the pipeline steps in seconds
+    '''
+    if pipeline is None:
+        # Imported here, recording a session does not need the pipeline and SciPy
+        from modular_pipeline import ModularPipeline
+        pipeline = ModularPipeline()
+    num_steps = len(log) if num_steps is None else min(num_steps, len(log))
+    speeds = log.column('speed')
+    episode_ends = (log.column('terminated') > 0) | (log.column('truncated') > 0)
+    actions = np.zeros((num_steps, 3))
+
+    duration = 0.0
+    for start, frames in log.chunks():
+        for i, observation in enumerate(frames[:max(num_steps - start, 0)]):
+            step = start + i
+            speed = None if np.isnan(speeds[step]) else speeds[step]
+            t = time.perf_counter()
+            actions[step] = pipeline.step(observation, speed=speed)
+            duration += time.perf_counter() - t
+            if episode_ends[step]:
+                pipeline.reset()
+    return actions, duration
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replays a recorded session through the modular pipeline")
+    parser.add_argument('log', type=str, help='log directory written by SessionRecorder')
+    parser.add_argument('--steps', type=int, default=None, help='number of replayed steps')
+    parser.add_argument('--save', type=str, default=None, help='write the replayed actions to this .npy file')
+    parser.add_argument('--reference', type=str, default=None, help='.npy actions of an earlier replay to compare with')
+    args = parser.parse_args()
+
+    from modular_pipeline import ModularPipeline
+
+    log = SessionLog(args.log)
+    pipeline = ModularPipeline()
+    actions, duration = replay(log, pipeline, args.steps)
+    print("replayed {} steps in {:.2f} s ({:.0f} steps/s)".format(len(actions), duration, len(actions) / max(duration, 1e-9)))
+    for stage, latency in pipeline.timing_summary().items():
+        print("{:<26s} {:8.3f} ms".format(stage, latency * 1e3))
+
+    if args.save:
+        np.save(args.save, actions)
+    if args.reference:
+        reference = np.load(args.reference)
+        num_steps = min(len(reference), len(actions))
+        difference = np.abs(actions[:num_steps] - reference[:num_steps])
+        print("max action difference to {}: {:.3g}, {} of {} steps differ".format(
+            args.reference, difference.max(initial=0), np.count_nonzero(difference.max(axis=1) > 0), num_steps))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+import threading
+
+import numpy as np
+from collections import OrderedDict
+from functools import lru_cache
+from scipy.interpolate import splev, BSpline
+
+
+@lru_cache(maxsize=None)
+def parameter_grid(num_samples):
+    '''
+    Read-only np.linspace(0, 1, num_samples), which is slow to recreate for every evaluation.
+    '''
+    u = np.linspace(0, 1, num_samples)
+    u.flags.writeable = False
+    return u
+
+
+class SplineBasisCache:
+    '''
+    LRU cache of B-spline basis matrices keyed by knot vector, degree and number of
+    uniformly spaced parameters, so repeated evaluations of splines with the same
+    knots become one matrix multiplication. Building a basis costs a few splev calls,
+    so a key is only cached once it has been requested min_requests times. Lookups
+    are locked, so the cache can be shared with a PipelinedExecutor worker thread.
+
+    functions:
+        basis()
+        clear()
+
+    init:
+        maxsize: Maximum number of cached basis matrices (default=256)
+        min_requests: Number of requests of a key before its basis is cached (default=4)
+    '''
+
+    def __init__(self, maxsize=256, min_requests=4):
+        self.maxsize = maxsize
+        self.min_requests = min_requests
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        self.bases = OrderedDict()
+        # Request counts of the keys not cached yet
+        self.seen = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def basis(self, knots, degree, num_samples):
+        '''
+        Basis matrix of the given knots at num_samples uniformly spaced parameters in [0, 1].
+
+        output:
+            [num_samples, num_coefficients] array, or None if the key is not cached yet
+        '''
+        key = (knots.tobytes(), degree, num_samples)
+        with self.lock:
+            basis = self.bases.get(key)
+            if basis is not None:
+                self.bases.move_to_end(key)
+                self.hits += 1
+                return basis
+
+            self.misses += 1
+            num_requests = self.seen.pop(key, 0) + 1
+            if num_requests < self.min_requests:
+                self.seen[key] = num_requests
+                if len(self.seen) > self.maxsize:
+                    self.seen.popitem(last=False)
+                return None
+
+        basis = BSpline.design_matrix(parameter_grid(num_samples), knots, degree).toarray()
+        basis.flags.writeable = False
+        with self.lock:
+            self.bases[key] = basis
+            if len(self.bases) > self.maxsize:
+                self.bases.popitem(last=False)
+        return basis
+
+
+# Basis cache used by evaluate_spline
+SPLINE_BASIS_CACHE = SplineBasisCache()
+
+
+def evaluate_spline(spline, num_samples):
+    '''
+    Evaluates a lane boundary spline at num_samples uniformly spaced parameters in [0, 1]
+    with a single matrix multiplication against a cached basis, falling back to splev
+    while its knots are not cached.
+
+    args:
+        spline: splprep tck tuple
+        num_samples: Number of evaluated points
+
+    output:
+        [2, num_samples]
+    '''
+    knots, coefficients, degree = spline
+    basis = SPLINE_BASIS_CACHE.basis(knots, degree, num_samples)
+    if basis is None:
+        return np.array(splev(parameter_grid(num_samples), spline))
+    return np.asarray(coefficients)[:, :basis.shape[1]] @ basis.T
@@ -0,0 +1,71 @@
+import numpy as np
+
+
+class TelemetryBuffer:
+    '''
+    Fixed-capacity ring buffer of numeric telemetry samples. Memory stays constant:
+    once full, each new sample overwrites the oldest one. With decimation > 1 only
+    every decimation-th appended sample is stored.
+
+    functions:
+        append()
+        snapshot()
+        clear()
+        export_npz()
+        export_csv()
+
+    init:
+        fields: Names of the values of a sample
+        capacity: Maximum number of stored samples (default=4096)
+        decimation: Store every decimation-th sample (default=1)
+    '''
+
+    def __init__(self, fields, capacity=4096, decimation=1):
+        self.fields = tuple(fields)
+        self.capacity = capacity
+        self.decimation = decimation
+        self.data = np.zeros((len(self.fields), capacity))
+        self.clear()
+
+    def clear(self):
+        self.num_appended = 0
+        self.num_stored = 0
+
+    def __len__(self):
+        return min(self.num_stored, self.capacity)
+
+    def append(self, *values):
+        '''
+        Appends one sample with a value per field.
+
+        Returns:
+            bool: True if the sample was stored, False if it was skipped by the decimation
+        '''
+        self.num_appended += 1
+        if (self.num_appended - 1) % self.decimation:
+            return False
+        self.data[:, self.num_stored % self.capacity] = values
+        self.num_stored += 1
+        return True
+
+    def snapshot(self):
+        '''
+        Copy of the stored samples in chronological order.
+
+        output:
+            dict of field name to [num_samples] array
+        '''
+        num_samples = len(self)
+        start = self.num_stored % self.capacity if self.num_stored > self.capacity else 0
+        data = np.roll(self.data[:, :num_samples], -start, axis=1)
+        return dict(zip(self.fields, data))
+
+    def export_npz(self, path):
+        '''Writes the stored samples as arrays named by field to an .npz file.'''
+        np.savez(path, **self.snapshot())
+
+    def export_csv(self, path):
+        '''Writes the stored samples to a CSV file with one column per field.'''
+        snapshot = self.snapshot()
+        np.savetxt(path, np.column_stack([snapshot[field] for field in self.fields]),
+                   fmt='%.10g', delimiter=',', header=','.join(self.fields), comments='')
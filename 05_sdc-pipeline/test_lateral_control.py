@@ -2,9 +2,7 @@ import gym
 import numpy as np
 import matplotlib.pyplot as plt
 
-from lane_detection import LaneDetection
-from waypoint_prediction import waypoint_prediction, target_speed_prediction
-from lateral_control import LateralController
+from modular_pipeline import ModularPipeline, PipelinedExecutor
 
 # Initialize environment using gym.make()
 env = gym.make('CarRacing-v2', render_mode='human')
@@ -14,10 +12,14 @@ env.reset()
 total_reward = 0.0
 steps = 0
 restart = False
+# Run perception and planning of each frame on a worker thread while the environment
+# steps with the action of the previous frame
+pipelined = False
 
-# Initialize modules of the pipeline
-LD_module = LaneDetection()
-LatC_module = LateralController()
+# Initialize modules of the pipeline, without longitudinal control
+pipeline = ModularPipeline(longitudinal_control=False)
+executor = PipelinedExecutor(pipeline) if pipelined else None
+LD_module = pipeline.LD_module
 
 # Initialize extra plot
 fig = plt.figure()
@@ -32,13 +34,6 @@ while True:
     observation, reward, terminated, truncated, info = env.step(a)
     done = terminated or truncated
 
-    # Lane detection
-    lane1, lane2 = LD_module.lane_detection(observation)
-
-    # Waypoint and target_speed prediction
-    waypoints = waypoint_prediction(lane1, lane2)
-    target_speed = target_speed_prediction(waypoints)
-
     # Control with constant gas and no braking
     # Obtain the speed from the info dictionary if available
     if 'speed' in info:
@@ -47,14 +42,20 @@ while True:
         # Alternatively, estimate speed or set a default value
         speed = 0.1  # Replace with appropriate speed estimation if necessary
 
-    # Update steering angle using the lateral controller
-    a[0] = LatC_module.stanley(waypoints, speed)
+    # Lane detection, waypoint and target_speed prediction and the steering angle of the lateral controller
+    if pipelined:
+        a[:] = executor.step(observation, info, speed)
+        waypoints, target_speed = executor.waypoints, executor.target_speed
+    else:
+        a[:] = pipeline.step(observation, info, speed)
+        waypoints, target_speed = pipeline.waypoints, pipeline.target_speed
 
     # Update total reward
     total_reward += reward
 
     # Outputs during training
-    if steps % 2 == 0 or done:
+    # No outputs before the first result, e.g. at the first pipelined step
+    if (steps % 2 == 0 or done) and target_speed is not None:
         print("\naction " + str(["{:+0.2f}".format(x) for x in a]))
         print("target_speed {:+0.2f}".format(target_speed))
         LD_module.plot_state_lane(observation, steps, fig, waypoints=waypoints)
@@ -67,4 +68,8 @@ while True:
         print("step {} total_reward {:+0.2f}".format(steps, total_reward))
         break
 
+if pipelined:
+    executor.close()
+    print("pipelining lag {lag_frames} frame, mean action age {mean_action_age:.4f} s, "
+          "max action age {max_action_age:.4f} s, mean wait {mean_wait:.4f} s".format(**executor.report()))
 env.close()
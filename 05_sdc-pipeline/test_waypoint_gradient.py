@@ -0,0 +1,32 @@
+import numpy as np
+import pytest
+from scipy.optimize import approx_fprime
+
+from waypoint_prediction import curvature_gradient, smoothing_objective, smoothing_objective_and_gradient
+
+
+def random_path(seed, num_waypoints=6):
+    # Waypoints ahead of the car like the center line of waypoint_prediction, with noise
+    rng = np.random.default_rng(seed)
+    rows = np.linspace(0, 68, num_waypoints)
+    cols = 48 + np.cumsum(rng.normal(0, 3, num_waypoints))
+    return np.stack((cols, rows)).ravel()
+
+
+@pytest.mark.parametrize("seed", range(5))
+@pytest.mark.parametrize("beta", [1, 30])
+def test_gradient_matches_finite_differences(seed, beta):
+    waypoints_center = random_path(seed)
+    waypoints = waypoints_center + np.random.default_rng(seed + 100).normal(0, 1, waypoints_center.shape)
+
+    objective, gradient = smoothing_objective_and_gradient(waypoints, waypoints_center, beta)
+    numerical = approx_fprime(waypoints, smoothing_objective, 1e-6, waypoints_center, beta)
+
+    assert objective == pytest.approx(smoothing_objective(waypoints, waypoints_center, beta))
+    assert np.linalg.norm(gradient - numerical) <= 1e-4 * np.linalg.norm(numerical)
+
+
+def test_batch_gradient_matches_single_paths():
+    batch = np.stack([random_path(seed).reshape(2, -1) for seed in range(4)])
+    expected = np.stack([curvature_gradient(waypoints) for waypoints in batch])
+    np.testing.assert_allclose(curvature_gradient(batch), expected)
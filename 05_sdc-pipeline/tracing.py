@@ -0,0 +1,205 @@
+import os
+import json
+import time
+import functools
+import threading
+
+import numpy as np
+
+
+class Tracer:
+    '''
+    Records named time spans with nanosecond resolution into a fixed-size ring
+    buffer. When the buffer is full, the oldest spans are overwritten. While
+    disabled, span() and traced functions only check the enabled flag. Spans may
+    be recorded from several threads, e.g. the worker of a PipelinedExecutor.
+
+    functions:
+        enable()
+        disable()
+        clear()
+        span()
+        record()
+        spans()
+        export_chrome_trace()
+        summary()
+        print_summary()
+
+    init:
+        capacity: Maximum number of stored spans (default=65536)
+    '''
+
+    def __init__(self, capacity=65536):
+        self.capacity = capacity
+        self.enabled = False
+        self.null_span = NullSpan()
+        # Serializes the slot assignment of concurrently recorded spans
+        self.lock = threading.Lock()
+        # Names are stored once, spans refer to them by index
+        self.names = []
+        self.name_ids = {}
+        self.clear()
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def clear(self):
+        '''Removes all recorded spans.'''
+        with self.lock:
+            # Plain lists, since per-span scalar writes into NumPy arrays are slower
+            self.name_index = [0] * self.capacity
+            self.starts = [0] * self.capacity
+            self.durations = [0] * self.capacity
+            self.thread_ids = [0] * self.capacity
+            self.num_recorded = 0
+
+    def span(self, name):
+        '''
+        Context manager measuring the enclosed block, e.g.
+            with TRACER.span("lane_detection.trace"):
+                ...
+        '''
+        if not self.enabled:
+            return self.null_span
+        return Span(self, name)
+
+    def record(self, name, start, end):
+        '''
+        Stores a span given its perf_counter_ns start and end time.
+        '''
+        thread_id = threading.get_ident()
+        with self.lock:
+            name_id = self.name_ids.get(name)
+            if name_id is None:
+                name_id = self.name_ids[name] = len(self.names)
+                self.names.append(name)
+            index = self.num_recorded % self.capacity
+            self.name_index[index] = name_id
+            self.starts[index] = start
+            self.durations[index] = end - start
+            self.thread_ids[index] = thread_id
+            self.num_recorded += 1
+
+    def spans(self):
+        '''
+        Stored spans in recording order.
+
+        output:
+            names: [N] span names
+            starts: [N] int64 start times in nanoseconds
+            durations: [N] int64 durations in nanoseconds
+            thread_ids: [N] int64 thread identifiers
+        '''
+        with self.lock:
+            num_spans = min(self.num_recorded, self.capacity)
+            # Unroll the ring buffer, starting at the oldest span
+            order = (np.arange(num_spans) + self.num_recorded - num_spans) % self.capacity
+            names = [self.names[self.name_index[i]] for i in order]
+            starts = np.array(self.starts, dtype=np.int64)[order]
+            durations = np.array(self.durations, dtype=np.int64)[order]
+            thread_ids = np.array(self.thread_ids, dtype=np.uint64)[order]
+        return names, starts, durations, thread_ids
+
+    def export_chrome_trace(self, path):
+        '''
+        Writes the stored spans as Chrome trace JSON, which can be opened in
+        chrome://tracing or https://ui.perfetto.dev.
+
+        args:
+            path: Output .json file
+        '''
+        names, starts, durations, thread_ids = self.spans()
+        origin = starts.min() if len(starts) else 0
+        pid = os.getpid()
+        # Small thread numbers are easier to read than thread identifiers
+        tids = {thread_id: tid for tid, thread_id in enumerate(dict.fromkeys(thread_ids.tolist()))}
+        events = [
+            {"name": name, "cat": name.split('.')[0], "ph": "X", "pid": pid, "tid": tids[thread_id],
+             "ts": (start - origin) / 1e3, "dur": duration / 1e3}
+            for name, start, duration, thread_id in zip(names, starts.tolist(), durations.tolist(), thread_ids.tolist())
+        ]
+        with open(path, 'w') as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+    def summary(self):
+        '''
+        Latency statistics per span name.
+
+        output:
+            dict of span name to dict with count, total, mean, p50, p95, p99 and max in microseconds
+        '''
+        names, _, durations, _ = self.spans()
+        names = np.array(names)
+        statistics = {}
+        for name in dict.fromkeys(names.tolist()):
+            microseconds = durations[names == name] / 1e3
+            p50, p95, p99 = np.percentile(microseconds, [50, 95, 99])
+            statistics[name] = {"count": len(microseconds), "total": microseconds.sum(), "mean": microseconds.mean(),
+                                "p50": p50, "p95": p95, "p99": p99, "max": microseconds.max()}
+        return statistics
+
+    def print_summary(self):
+        '''
+        Prints the summary table sorted by total time.
+        '''
+        statistics = self.summary()
+        print("{:<40}{:>8}{:>12}{:>10}{:>10}{:>10}{:>10}".format("span [us]", "count", "total", "mean", "p50", "p95", "max"))
+        for name, row in sorted(statistics.items(), key=lambda item: -item[1]["total"]):
+            print("{:<40}{:>8}{:>12.0f}{:>10.1f}{:>10.1f}{:>10.1f}{:>10.1f}".format(
+                name, row["count"], row["total"], row["mean"], row["p50"], row["p95"], row["max"]))
+        if self.num_recorded > self.capacity:
+            print("only the last {} of {} spans are stored".format(self.capacity, self.num_recorded))
+
+
+class Span:
+    __slots__ = ('tracer', 'name', 'start')
+
+    def __init__(self, tracer, name):
+        self.tracer = tracer
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.tracer.record(self.name, self.start, time.perf_counter_ns())
+
+
+class NullSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+# Tracer shared by the pipeline modules
+TRACER = Tracer()
+
+
+def traced(name, tracer=TRACER):
+    '''
+    Decorator recording every call of a function as a span.
+
+    args:
+        name: Span name, by convention "<module>.<stage>"
+        tracer: Tracer receiving the spans (default=TRACER)
+    '''
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not tracer.enabled:
+                return func(*args, **kwargs)
+            start = time.perf_counter_ns()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                tracer.record(name, start, time.perf_counter_ns())
+        return wrapper
+    return decorator
@@ -0,0 +1,155 @@
+import numpy as np
+
+# Kinematic bicycle model in metres and seconds
+DT = 0.02  # CarRacing runs at 50 frames per second
+WHEELBASE = 2.5
+MAX_STEERING_ANGLE = 0.4  # Steering action 1 corresponds to 0.4 rad like in LateralController.stanley
+MAX_ACCELERATION = 10.0
+MAX_DECELERATION = 20.0
+DRAG = 0.05
+WAYPOINT_SPACING = 5.0
+OFF_TRACK_DISTANCE = 10.0
+# Number of center line points ahead of the last nearest point searched per step
+SEARCH_WINDOW = 50
+
+
+def generate_track(seed, length=1500.0, spacing=1.0, max_curvature=0.05):
+    '''
+    Procedurally generated road center line with a smooth random curvature profile.
+
+    args:
+        seed: Random seed of the track
+        length: Track length in metres (default=1500)
+        spacing: Distance between center line points in metres (default=1)
+        max_curvature: Maximum curvature in 1/m (default=0.05)
+
+    output:
+        points: [2, num_points] center line starting at the origin heading along x
+    '''
+    rng = np.random.default_rng(seed)
+    s = np.arange(0, length, spacing)
+    # Sum of a few random sinusoids, straight for the first 50 m
+    frequencies = rng.uniform(1 / 400, 1 / 60, 4)
+    phases = rng.uniform(0, 2 * np.pi, 4)
+    amplitudes = rng.uniform(0.2, 1.0, 4)
+    curvature = np.sum(amplitudes[:, None] * np.sin(2 * np.pi * frequencies[:, None] * s + phases[:, None]), axis=0)
+    curvature *= max_curvature / np.max(np.abs(curvature)) * np.clip(s / 50 - 1, 0, 1)
+
+    heading = np.concatenate(([0], np.cumsum(curvature[:-1]) * spacing))
+    points = np.stack((np.cumsum(np.cos(heading)) * spacing, np.cumsum(np.sin(heading)) * spacing))
+    return points - points[:, :1]
+
+
+class VehicleSimulator:
+    '''
+    Kinematic bicycle model of several vehicles on procedurally generated tracks,
+    stepped together in one vectorized call. Each vehicle observes the waypoints
+    ahead of it in vehicle coordinates (x forward, y left), one [2, num_waypoints]
+    array per vehicle like LateralController.stanley and target_speed_prediction
+    expect. The first waypoint is the nearest center line point.
+
+    A vehicle is done when it leaves the track (more than OFF_TRACK_DISTANCE from
+    the center line) or reaches its end. Done vehicles keep their state. The
+    cross_track_error attribute holds the distance of each vehicle to the center line.
+
+    functions:
+        reset()
+        observe()
+        step()
+
+    init:
+        tracks: list of [2, num_points] center lines with the same point spacing
+        track_index: Track of each vehicle (default: vehicle i drives track i)
+        num_waypoints: (default=6)
+        waypoint_spacing: Distance between the waypoints in metres (default=5)
+        dt: Step duration in seconds (default=0.02)
+    '''
+
+    def __init__(self, tracks, track_index=None, num_waypoints=6, waypoint_spacing=WAYPOINT_SPACING, dt=DT):
+        # Pad the tracks to a common length by repeating their last point
+        num_points = max(track.shape[1] for track in tracks)
+        self.tracks = np.stack([np.pad(track, ((0, 0), (0, num_points - track.shape[1])), mode='edge') for track in tracks])
+        self.track_lengths = np.array([track.shape[1] for track in tracks])
+        self.track_spacing = np.hypot(*(tracks[0][:, 1] - tracks[0][:, 0]))
+
+        self.track_index = np.arange(len(tracks)) if track_index is None else np.asarray(track_index)
+        self.num_vehicles = len(self.track_index)
+        self.num_waypoints = num_waypoints
+        self.waypoint_offsets = np.round(np.arange(num_waypoints) * waypoint_spacing / self.track_spacing).astype(int)
+        self.dt = dt
+        self.reset()
+
+    def reset(self):
+        '''
+        Places every vehicle at rest at the start of its track.
+
+        Returns:
+            tuple: (waypoints [num_vehicles, 2, num_waypoints], speed [num_vehicles])
+        '''
+        self.position = np.zeros((self.num_vehicles, 2))
+        self.heading = np.zeros(self.num_vehicles)
+        self.speed = np.zeros(self.num_vehicles)
+        self.nearest = np.zeros(self.num_vehicles, dtype=int)
+        self.off_track = np.zeros(self.num_vehicles, dtype=bool)
+        self.finished = np.zeros(self.num_vehicles, dtype=bool)
+        self.num_steps = 0
+        return self.observe(), self.speed.copy()
+
+    @property
+    def done(self):
+        return self.off_track | self.finished
+
+    def observe(self):
+        '''
+        Updates the nearest center line points and returns the waypoints of all vehicles.
+
+        Returns:
+            numpy.ndarray: [num_vehicles, 2, num_waypoints] waypoints in vehicle coordinates
+        '''
+        vehicles = np.arange(self.num_vehicles)[:, None]
+        last_index = self.track_lengths[self.track_index][:, None] - 1
+
+        # Nearest center line point in a window ahead of the last one
+        window = np.minimum(self.nearest[:, None] + np.arange(SEARCH_WINDOW), last_index)
+        window_points = self.tracks[self.track_index[:, None], :, window]  # [V, W, 2]
+        distances = np.sum((window_points - self.position[:, None]) ** 2, axis=2)
+        nearest = window[vehicles[:, 0], np.argmin(distances, axis=1)]
+        self.nearest = np.where(self.done, self.nearest, nearest)
+        self.finished |= self.nearest >= last_index[:, 0]
+
+        # Waypoints rotated into the vehicle frame
+        indices = np.minimum(self.nearest[:, None] + self.waypoint_offsets, last_index)
+        offset = self.tracks[self.track_index[:, None], :, indices] - self.position[:, None]  # [V, N, 2]
+        cos, sin = np.cos(self.heading)[:, None], np.sin(self.heading)[:, None]
+        waypoints = np.stack((cos * offset[..., 0] + sin * offset[..., 1], -sin * offset[..., 0] + cos * offset[..., 1]), axis=1)
+
+        # Distance to the center line through the nearest point, which is finer than the point spacing
+        following = np.minimum(self.nearest + 1, last_index[:, 0])
+        preceding = np.maximum(following - 1, 0)
+        tangent = self.tracks[self.track_index, :, following] - self.tracks[self.track_index, :, preceding]
+        tangent /= np.linalg.norm(tangent, axis=1, keepdims=True)
+        offset = self.position - self.tracks[self.track_index, :, self.nearest]
+        self.cross_track_error = np.abs(tangent[:, 0] * offset[:, 1] - tangent[:, 1] * offset[:, 0])
+        self.off_track |= self.cross_track_error > OFF_TRACK_DISTANCE
+        return waypoints
+
+    def step(self, steering, gas, brake):
+        '''
+        Advances all vehicles that are not done by one time step.
+
+        Args:
+            steering (numpy.ndarray): [num_vehicles] steering actions in [-1, 1], positive turns towards +y
+            gas (numpy.ndarray): [num_vehicles] throttle in [0, 1]
+            brake (numpy.ndarray): [num_vehicles] brake in [0, 1]
+
+        Returns:
+            tuple: (waypoints [num_vehicles, 2, num_waypoints], speed [num_vehicles])
+        '''
+        active = ~self.done
+        dt = self.dt * active
+        self.position += (self.speed * dt)[:, None] * np.stack((np.cos(self.heading), np.sin(self.heading)), axis=1)
+        self.heading += self.speed * dt / WHEELBASE * np.tan(np.asarray(steering) * MAX_STEERING_ANGLE)
+        acceleration = MAX_ACCELERATION * np.asarray(gas) - MAX_DECELERATION * np.asarray(brake) - DRAG * self.speed
+        self.speed = np.maximum(self.speed + acceleration * dt, 0.0)
+        self.num_steps += 1
+        return self.observe(), self.speed.copy()
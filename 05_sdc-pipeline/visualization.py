@@ -0,0 +1,233 @@
+import queue
+import threading
+
+import numpy as np
+from matplotlib import animation
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+
+class LanePlot:
+    '''
+    Camera image with lane boundaries and waypoints. The artists are created once and
+    only their data changes per update. With blit=True only the artists are redrawn
+    on top of a cached background.
+
+    init:
+        fig: Matplotlib figure to draw into (cleared)
+        cut_size: Cut size of the lane detection (default=68)
+        blit: Redraw with blitting, False leaves drawing to the caller (default=True)
+    '''
+
+    def __init__(self, fig, cut_size=68, blit=True):
+        self.fig = fig
+        self.cut_size = cut_size
+        self.blit = blit
+
+        fig.clear()
+        self.ax = fig.add_axes([0, 0, 1, 1])
+        self.ax.axis('off')
+        self.ax.set_xlim((-0.5, 95.5))
+        self.ax.set_ylim((-0.5, 95.5))
+        self.image = self.ax.imshow(np.zeros((96, 96, 3), dtype=np.uint8), animated=blit)
+        self.lane_lines = [self.ax.plot([], [], linewidth=5, color='orange', animated=blit)[0] for _ in range(2)]
+        self.waypoint_scatter = self.ax.scatter([], [], color='white', animated=blit)
+        self.artists = [self.image] + self.lane_lines + [self.waypoint_scatter]
+
+        self.background = None
+        if blit:
+            # Recapture the background whenever the whole figure is redrawn, e.g. on resize
+            fig.canvas.mpl_connect('draw_event', self.on_draw)
+            fig.canvas.draw()
+
+    def on_draw(self, event):
+        self.background = self.fig.canvas.copy_from_bbox(self.fig.bbox)
+        self.draw_artists()
+
+    def draw_artists(self):
+        for artist in self.artists:
+            self.ax.draw_artist(artist)
+
+    def update(self, state_image_full, lane_boundary1_points, lane_boundary2_points, waypoints=[]):
+        '''
+        Args:
+            state_image_full (numpy.ndarray): Image of size 96 x 96 x 3.
+            lane_boundary1_points (numpy.ndarray): 2 x num_points points of the first boundary.
+            lane_boundary2_points (numpy.ndarray): 2 x num_points points of the second boundary.
+            waypoints (numpy.ndarray): 2 x num_waypoints waypoints, may be empty.
+        '''
+        offset = 96 - self.cut_size
+        self.image.set_data(state_image_full[::-1])
+        for line, points in zip(self.lane_lines, (lane_boundary1_points, lane_boundary2_points)):
+            line.set_data(points[0], points[1] + offset)
+        if len(waypoints):
+            self.waypoint_scatter.set_offsets(np.column_stack((waypoints[0], waypoints[1] + offset)))
+        else:
+            self.waypoint_scatter.set_offsets(np.empty((0, 2)))
+
+        if self.blit:
+            canvas = self.fig.canvas
+            canvas.restore_region(self.background)
+            self.draw_artists()
+            canvas.blit(self.fig.bbox)
+            canvas.flush_events()
+
+
+class SpeedPlot:
+    '''
+    Speed and target speed over the steps. The lines are updated in place and redrawn
+    with blitting. The axis limits change in steps, which needs a full redraw only then.
+
+    init:
+        fig: Matplotlib figure to draw into (cleared)
+        blit: Redraw with blitting, False leaves drawing to the caller (default=True)
+    '''
+
+    def __init__(self, fig, blit=True):
+        self.fig = fig
+        self.blit = blit
+
+        fig.clear()
+        self.ax = fig.add_subplot(1, 1, 1)
+        self.ax.set_xlim((0, 100))
+        self.ax.set_ylim((0, 10))
+        self.speed_line = self.ax.plot([], [], c="green", animated=blit)[0]
+        self.target_speed_line = self.ax.plot([], [], animated=blit)[0]
+        self.artists = [self.speed_line, self.target_speed_line]
+
+        self.background = None
+        if blit:
+            fig.canvas.mpl_connect('draw_event', self.on_draw)
+            fig.canvas.draw()
+
+    def on_draw(self, event):
+        self.background = self.fig.canvas.copy_from_bbox(self.fig.bbox)
+        self.draw_artists()
+
+    def draw_artists(self):
+        for artist in self.artists:
+            self.ax.draw_artist(artist)
+
+    def update(self, steps, speeds, target_speeds):
+        '''
+        Args:
+            steps (numpy.ndarray): Steps of the samples.
+            speeds (numpy.ndarray): Vehicle speed per step.
+            target_speeds (numpy.ndarray): Target speed per step.
+        '''
+        self.speed_line.set_data(steps, speeds)
+        self.target_speed_line.set_data(steps, target_speeds)
+        if len(steps) == 0:
+            return
+
+        # Grow the limits geometrically so full redraws stay rare. Once the history is
+        # bounded, the x range slides forward by about one history length at a time
+        rescale = False
+        x_min, x_max = self.ax.get_xlim()
+        if steps[-1] > x_max or steps[0] < x_min:
+            self.ax.set_xlim((steps[0], steps[0] + max(2 * (steps[-1] - steps[0]), x_max - x_min)))
+            rescale = True
+        y_min, y_max = self.ax.get_ylim()
+        low = min(np.min(speeds), np.min(target_speeds))
+        high = max(np.max(speeds), np.max(target_speeds))
+        if low < y_min or high > y_max:
+            margin = 0.25 * (high - low) + 1
+            self.ax.set_ylim((min(y_min, low - margin), max(y_max, high + margin)))
+            rescale = True
+
+        if self.blit:
+            canvas = self.fig.canvas
+            if rescale:
+                # Redraws the axes and recaptures the background through on_draw
+                canvas.draw()
+            else:
+                canvas.restore_region(self.background)
+                self.draw_artists()
+                canvas.blit(self.fig.bbox)
+            canvas.flush_events()
+
+
+class BackgroundVideoWriter:
+    '''
+    Renders lane detection frames into a video file on a background thread, so the
+    control loop only pays for copying the data. If the renderer falls behind and the
+    queue is full, frames are dropped instead of blocking. An exception of the renderer
+    stops the thread, later frames are dropped and close() raises the exception.
+
+    functions:
+        submit()
+        close()
+
+    init:
+        path: Output video file
+        fps: Frames per second of the video (default=25)
+        cut_size: Cut size of the lane detection (default=68)
+        writer: Matplotlib animation writer name, e.g. "ffmpeg" or "pillow" (default="ffmpeg")
+        max_queue: Maximum number of frames waiting to be rendered (default=64)
+        dpi: Resolution of the video frames (default=100)
+    '''
+
+    def __init__(self, path, fps=25, cut_size=68, writer="ffmpeg", max_queue=64, dpi=100):
+        self.path = path
+        self.cut_size = cut_size
+        self.dpi = dpi
+        self.writer = animation.writers[writer](fps=fps)
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.num_written = 0
+        self.num_dropped = 0
+        self.error = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, state_image_full, lane_boundary1_points, lane_boundary2_points, waypoints=[]):
+        '''
+        Queues a frame for rendering without blocking.
+
+        Returns:
+            bool: False if the frame was dropped
+        '''
+        if not self.thread.is_alive():
+            self.num_dropped += 1
+            return False
+        frame = (np.array(state_image_full), np.array(lane_boundary1_points),
+                 np.array(lane_boundary2_points), np.array(waypoints))
+        try:
+            self.queue.put_nowait(frame)
+        except queue.Full:
+            self.num_dropped += 1
+            return False
+        return True
+
+    def run(self):
+        try:
+            self.render()
+        except Exception as error:
+            # Raised again by close() on the calling thread
+            self.error = error
+
+    def render(self):
+        # Agg figure without pyplot, which is not thread-safe
+        fig = Figure(figsize=(4, 4))
+        FigureCanvasAgg(fig)
+        plot = LanePlot(fig, self.cut_size, blit=False)
+        with self.writer.saving(fig, self.path, self.dpi):
+            while True:
+                frame = self.queue.get()
+                if frame is None:
+                    break
+                plot.update(*frame)
+                self.writer.grab_frame()
+                self.num_written += 1
+
+    def close(self):
+        '''Renders the queued frames and finishes the video file.'''
+        # A full queue is only drained while the renderer is alive
+        while self.thread.is_alive():
+            try:
+                self.queue.put(None, timeout=0.1)
+                break
+            except queue.Full:
+                pass
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
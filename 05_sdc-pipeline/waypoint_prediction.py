@@ -1,6 +1,14 @@
+import time
 import numpy as np
-from scipy.interpolate import splev
+from functools import lru_cache
 from scipy.optimize import minimize
+from scipy.linalg import cholesky_banded, cho_solve_banded
+
+from spline_fitting import evaluate_spline
+from tracing import traced
+
+# Resolution in pixels to which the "fast" mode rounds the waypoint spacing, so its factors can be cached
+SPACING_RESOLUTION = 0.5
 
 def normalize(v):
     norm = np.linalg.norm(v, axis=0) + 1e-10  # Avoid division by zero
@@ -46,24 +54,134 @@ def smoothing_objective(waypoints_flat, waypoints_center_flat, beta=30):
     objective = ls_tocenter - beta * curv
     return objective
 
+def curvature_gradient(waypoints):
+    '''
+    Gradient of the curvature term with respect to the waypoints.
+
+    args:
+        waypoints: [2, num_waypoints] or a batch [B, 2, num_waypoints]
+
+    output:
+        same shape as waypoints
+    '''
+    delta_waypoints = waypoints[..., 1:] - waypoints[..., :-1]  # Shape: [..., 2, N-1]
+    lengths = np.linalg.norm(delta_waypoints, axis=-2, keepdims=True)
+    norm = lengths + 1e-10
+    delta_waypoints_normalized = delta_waypoints / norm
+
+    # Derivative of the sum of dot products with respect to each normalized segment
+    grad_normalized = np.zeros_like(delta_waypoints)
+    grad_normalized[..., :-1] += delta_waypoints_normalized[..., 1:]
+    grad_normalized[..., 1:] += delta_waypoints_normalized[..., :-1]
+
+    # Chain rule through d / (|d| + eps): (g - d / |d| * (d . g) / (|d| + eps)) / (|d| + eps)
+    unit = delta_waypoints / np.where(lengths > 0, lengths, 1)
+    projection = np.sum(delta_waypoints_normalized * grad_normalized, axis=-2, keepdims=True)
+    grad_delta = (grad_normalized - unit * projection) / norm
+
+    # Each segment is the difference of two neighbouring waypoints
+    grad = np.zeros_like(waypoints)
+    grad[..., 1:] += grad_delta
+    grad[..., :-1] -= grad_delta
+    return grad
+
+def smoothing_objective_and_gradient(waypoints_flat, waypoints_center_flat, beta=30):
+    '''
+    Objective function for path smoothing and its exact gradient, for minimize(jac=True).
+
+    args:
+        waypoints_flat: [2 * num_waypoints] flattened waypoints array to optimize
+        waypoints_center_flat: [2 * num_waypoints] flattened center waypoints array
+        beta: smoothing parameter
+
+    output:
+        objective (float), gradient [2 * num_waypoints]
+    '''
+    num_waypoints = waypoints_center_flat.shape[0] // 2
+    waypoints = waypoints_flat.reshape(2, num_waypoints)
+    waypoints_center = waypoints_center_flat.reshape(2, num_waypoints)
+
+    difference = waypoints - waypoints_center
+    objective = np.sum(difference ** 2) - beta * curvature(waypoints)
+    gradient = 2 * difference - beta * curvature_gradient(waypoints)
+    return objective, gradient.ravel()
+
+@lru_cache(maxsize=256)
+def fast_smoothing_factor(num_waypoints, spacing, beta=30):
+    '''
+    Banded Cholesky factor of I + lambda * D^T D, where D takes the second differences
+    of the waypoints. Minimizing |x - y|^2 + lambda * |D x|^2 is the quadratic counterpart
+    of the smoothing objective: for small angles the curvature term penalizes the squared
+    turning angle, i.e. the second difference divided by the waypoint spacing.
+
+    args:
+        num_waypoints: Number of waypoints
+        spacing: Distance between neighbouring waypoints in pixels
+        beta: smoothing parameter
+
+    output:
+        [3, num_waypoints] upper banded Cholesky factor for cho_solve_banded
+    '''
+    # Squared turning angle weighted with beta / 4
+    smoothness = beta / (4 * spacing ** 2)
+
+    second_difference = np.diff(np.eye(num_waypoints), 2, axis=0)
+    matrix = np.eye(num_waypoints) + smoothness * second_difference.T @ second_difference
+    # Upper banded storage: row 2 - k holds the k-th superdiagonal
+    banded = np.zeros((3, num_waypoints))
+    for k in range(3):
+        banded[2 - k, k:] = np.diagonal(matrix, k)
+    factor = cholesky_banded(banded)
+    factor.flags.writeable = False
+    return factor
+
+def fast_smoothing(waypoints_center, beta=30):
+    '''
+    Closed-form path smoothing with a quadratic smoothness penalty, weighted by the
+    mean waypoint spacing of each path rounded to SPACING_RESOLUTION.
+
+    args:
+        waypoints_center: [2, num_waypoints] center waypoints or a batch [B, 2, num_waypoints]
+        beta: smoothing parameter
+
+    output:
+        waypoints: same shape as waypoints_center
+    '''
+    num_waypoints = waypoints_center.shape[-1]
+    paths = waypoints_center.reshape(-1, 2, num_waypoints)
+    delta = paths[:, :, 1:] - paths[:, :, :-1]
+    spacing = np.sqrt(delta[:, 0] ** 2 + delta[:, 1] ** 2).sum(axis=1) / max(num_waypoints - 1, 1)
+    steps = np.maximum(np.rint(spacing / SPACING_RESOLUTION), 1).tolist()
+
+    if len(steps) == 1:
+        factor = fast_smoothing_factor(num_waypoints, steps[0] * SPACING_RESOLUTION, beta)
+        return cho_solve_banded((factor, False), paths[0].T).T.reshape(waypoints_center.shape)
+    waypoints = np.empty(paths.shape)
+    for step in set(steps):
+        factor = fast_smoothing_factor(num_waypoints, step * SPACING_RESOLUTION, beta)
+        # Both coordinates of all paths with this spacing are solved against the same factor
+        selected = np.array(steps) == step
+        rows = paths[selected].reshape(-1, num_waypoints)
+        waypoints[selected] = cho_solve_banded((factor, False), rows.T).T.reshape(-1, 2, num_waypoints)
+    return waypoints.reshape(waypoints_center.shape)
+
+@traced("waypoint_prediction.waypoint_prediction")
 def waypoint_prediction(roadside1_spline, roadside2_spline, num_waypoints=6, way_type="smooth"):
     '''
-    Predict waypoints via two different methods:
+    Predict waypoints via three different methods:
     - "center": Directly use the midpoints between lane boundaries
     - "smooth": Smooth the path by optimizing the waypoints
+    - "fast": Smooth the path with a quadratic penalty in closed form
 
     args:
-        roadside1_spline: Spline representation of the first roadside
-        roadside2_spline: Spline representation of the second roadside
+        roadside1_spline: Spline representation of the first roadside (tck tuple)
+        roadside2_spline: Spline representation of the second roadside (tck tuple)
         num_waypoints: Number of waypoints to generate (default=6)
-        way_type: "center" or "smooth" (default="smooth")
+        way_type: "center", "smooth" or "fast" (default="smooth")
     '''
-    # Create spline parameter values from 0 to a value less than or equal to 1
-    u = np.linspace(0, 1, num_waypoints)
-
-    # Derive roadside points from splines
-    roadside1_points = np.array(splev(u, roadside1_spline))  # Shape: [2, num_waypoints]
-    roadside2_points = np.array(splev(u, roadside2_spline))  # Shape: [2, num_waypoints]
+    # Derive roadside points from splines at parameter values from 0 to 1
+    roadside1_points = evaluate_spline(roadside1_spline, num_waypoints)  # Shape: [2, num_waypoints]
+    roadside2_points = evaluate_spline(roadside2_spline, num_waypoints)  # Shape: [2, num_waypoints]
 
     # Calculate the midpoints between corresponding roadside points
     waypoints_center = (roadside1_points + roadside2_points) / 2  # Shape: [2, num_waypoints]
@@ -72,16 +190,20 @@ def waypoint_prediction(roadside1_spline, roadside2_spline, num_waypoints=6, way
         # Output waypoints with shape (2 x num_waypoints)
         return waypoints_center
 
+    elif way_type == "fast":
+        return fast_smoothing(waypoints_center)
+
     elif way_type == "smooth":
         # Flatten the waypoints for optimization
         waypoints_center_flat = waypoints_center.flatten()
 
         # Optimization to smooth the path
         result = minimize(
-            smoothing_objective,
+            smoothing_objective_and_gradient,
             waypoints_center_flat,
             args=(waypoints_center_flat),
-            method='L-BFGS-B'
+            method='L-BFGS-B',
+            jac=True
         )
 
         # Retrieve the optimized waypoints
@@ -90,6 +212,222 @@ def waypoint_prediction(roadside1_spline, roadside2_spline, num_waypoints=6, way
 
         return waypoints_smoothed
 
+def smoothing_objective_batch(waypoints, waypoints_center, beta=30):
+    '''
+    Objective function for path smoothing and its gradient for a batch of paths.
+
+    args:
+        waypoints: [B, 2, num_waypoints] waypoints to optimize
+        waypoints_center: [B, 2, num_waypoints] center waypoints
+        beta: smoothing parameter
+
+    output:
+        objective [B], gradient [B, 2, num_waypoints]
+    '''
+    difference = waypoints - waypoints_center
+    delta_waypoints = waypoints[..., 1:] - waypoints[..., :-1]
+    delta_waypoints_normalized = delta_waypoints / (np.linalg.norm(delta_waypoints, axis=-2, keepdims=True) + 1e-10)
+    curv = np.sum(delta_waypoints_normalized[..., :-1] * delta_waypoints_normalized[..., 1:], axis=(-2, -1))
+
+    objective = np.sum(difference ** 2, axis=(-2, -1)) - beta * curv
+    gradient = 2 * difference - beta * curvature_gradient(waypoints)
+    return objective, gradient
+
+def smooth_waypoints_batch(waypoints_center, beta=30, tolerance=1e-6, max_iterations=200):
+    '''
+    Smooths a batch of paths at once by gradient descent with Barzilai-Borwein step
+    sizes and a backtracking line search, all vectorized over the batch. Like
+    L-BFGS-B in waypoint_prediction, every path starts at its center line and
+    stops once the relative decrease of its objective falls below the tolerance.
+
+    args:
+        waypoints_center: [B, 2, num_waypoints] center waypoints
+        beta: smoothing parameter (default=30)
+        tolerance: Relative objective decrease at which a path is converged (default=1e-6)
+        max_iterations: Maximum number of iterations (default=200)
+
+    output:
+        waypoints: [B, 2, num_waypoints] smoothed waypoints
+        iterations: Number of iterations until all paths converged
+    '''
+    waypoints_center = np.asarray(waypoints_center, dtype=np.float64)
+    waypoints = waypoints_center.copy()
+    objective, gradient = smoothing_objective_batch(waypoints, waypoints_center, beta)
+    # The least-squares term alone has the Hessian 2 I, so 0.5 is its Newton step
+    step = np.full(waypoints.shape[0], 0.5)
+    active = np.arange(waypoints.shape[0])
+
+    iterations = 0
+    while active.size and iterations < max_iterations:
+        iterations += 1
+        x, f, g, center = waypoints[active], objective[active], gradient[active], waypoints_center[active]
+        squared_gradient = np.sum(g ** 2, axis=(1, 2))
+
+        # Backtracking until the Armijo condition holds, only for the paths still searching
+        x_new, f_new, g_new = x.copy(), f.copy(), g.copy()
+        t = step[active]
+        searching = np.arange(active.size)
+        for _ in range(30):
+            x_try = x[searching] - t[searching, None, None] * g[searching]
+            f_try, g_try = smoothing_objective_batch(x_try, center[searching], beta)
+            accepted = f_try <= f[searching] - 1e-4 * t[searching] * squared_gradient[searching]
+            x_new[searching[accepted]] = x_try[accepted]
+            f_new[searching[accepted]] = f_try[accepted]
+            g_new[searching[accepted]] = g_try[accepted]
+            searching = searching[~accepted]
+            if not searching.size:
+                break
+            t[searching] *= 0.5
+
+        # Barzilai-Borwein step size for the next iteration
+        s_k = x_new - x
+        y_k = g_new - g
+        sy = np.sum(s_k * y_k, axis=(1, 2))
+        ss = np.sum(s_k ** 2, axis=(1, 2))
+        step[active] = np.where(sy > 1e-12, np.clip(ss / np.where(sy > 1e-12, sy, 1), 1e-3, 10), 0.5)
+
+        waypoints[active], objective[active], gradient[active] = x_new, f_new, g_new
+        converged = f - f_new <= tolerance * np.maximum(np.maximum(np.abs(f), np.abs(f_new)), 1)
+        active = active[~converged]
+
+    return waypoints, iterations
+
+@traced("waypoint_prediction.waypoint_prediction_batch")
+def waypoint_prediction_batch(roadside1_splines, roadside2_splines, num_waypoints=6, way_type="smooth", beta=30):
+    '''
+    Batched waypoint_prediction for many frames or vehicles.
+
+    args:
+        roadside1_splines: B splines of the first roadside (tck tuples)
+        roadside2_splines: B splines of the second roadside (tck tuples)
+        num_waypoints: Number of waypoints to generate (default=6)
+        way_type: "center", "smooth" or "fast" (default="smooth")
+        beta: smoothing parameter (default=30)
+
+    output:
+        waypoints: [B, 2, num_waypoints]
+    '''
+    roadside1_points = np.stack([evaluate_spline(spline, num_waypoints) for spline in roadside1_splines])
+    roadside2_points = np.stack([evaluate_spline(spline, num_waypoints) for spline in roadside2_splines])
+    waypoints_center = (roadside1_points + roadside2_points) / 2  # Shape: [B, 2, num_waypoints]
+
+    if way_type == "center":
+        return waypoints_center
+    elif way_type == "fast":
+        return fast_smoothing(waypoints_center, beta)
+    elif way_type == "smooth":
+        return smooth_waypoints_batch(waypoints_center, beta)[0]
+
+class WaypointPlanner:
+    '''
+    Stateful waypoint prediction for consecutive frames. The "smooth" optimization is
+    warm-started from the previous solution, shifted along with the new center line,
+    and stops at a tolerance or at an iteration cap derived from a latency budget.
+
+    functions:
+        waypoint_prediction()
+        reset()
+
+    init:
+        num_waypoints: Number of waypoints to generate (default=6)
+        way_type: "center", "smooth" or "fast" (default="smooth")
+        beta: Smoothing parameter (default=30)
+        tolerance: Stopping tolerance of L-BFGS-B on the objective and the gradient (default=1e-6)
+        max_iterations: Maximum number of L-BFGS-B iterations per frame (default=50)
+        latency_budget: Seconds per frame, further limits the iterations if set (default=None)
+    '''
+
+    def __init__(self, num_waypoints=6, way_type="smooth", beta=30, tolerance=1e-6, max_iterations=50,
+                 latency_budget=None):
+        self.num_waypoints = num_waypoints
+        self.way_type = way_type
+        self.beta = beta
+        self.tolerance = tolerance
+        self.max_iterations = max_iterations
+        self.latency_budget = latency_budget
+
+        # Running average of the time per iteration, used for the latency budget
+        self.time_per_iteration = None
+
+        # Statistics of the last frame and totals
+        self.iterations = 0
+        self.time = 0.0
+        self.warm_started = False
+        self.num_frames = 0
+        self.total_iterations = 0
+        self.total_time = 0.0
+        self.reset()
+
+    def reset(self):
+        '''Drops the previous solution, e.g. at the start of an episode.'''
+        self.waypoints_offset_old = None
+
+    def iteration_cap(self):
+        '''
+        Maximum number of iterations for the next frame.
+        '''
+        if self.latency_budget is None or self.time_per_iteration is None:
+            return self.max_iterations
+        return int(max(1, min(self.max_iterations, self.latency_budget / self.time_per_iteration)))
+
+    @traced("waypoint_prediction.planner")
+    def waypoint_prediction(self, roadside1_spline, roadside2_spline):
+        '''
+        Predicts the waypoints like waypoint_prediction, warm-started from the previous frame.
+
+        args:
+            roadside1_spline: Spline representation of the first roadside (tck tuple)
+            roadside2_spline: Spline representation of the second roadside (tck tuple)
+
+        output:
+            waypoints: [2, num_waypoints]
+        '''
+        start = time.perf_counter()
+        waypoints_center = waypoint_prediction(roadside1_spline, roadside2_spline, self.num_waypoints, way_type="center")
+        if self.way_type == "center":
+            return waypoints_center
+        elif self.way_type == "fast":
+            return fast_smoothing(waypoints_center, self.beta)
+
+        waypoints_center_flat = waypoints_center.flatten()
+        x0 = waypoints_center_flat
+        self.warm_started = False
+        if self.waypoints_offset_old is not None:
+            # Keep the previous offset of the solution from the center line if it is a better start
+            x0_warm = waypoints_center_flat + self.waypoints_offset_old
+            objective_warm, _ = smoothing_objective_and_gradient(x0_warm, waypoints_center_flat, self.beta)
+            objective_cold, _ = smoothing_objective_and_gradient(x0, waypoints_center_flat, self.beta)
+            if objective_warm < objective_cold:
+                x0 = x0_warm
+                self.warm_started = True
+
+        result = minimize(
+            smoothing_objective_and_gradient,
+            x0,
+            args=(waypoints_center_flat, self.beta),
+            method='L-BFGS-B',
+            jac=True,
+            tol=self.tolerance,
+            options={'maxiter': self.iteration_cap()}
+        )
+        self.waypoints_offset_old = result.x - waypoints_center_flat
+
+        # Statistics
+        self.iterations = result.nit
+        self.time = time.perf_counter() - start
+        self.num_frames += 1
+        self.total_iterations += result.nit
+        self.total_time += self.time
+        if result.nit > 0:
+            time_per_iteration = self.time / result.nit
+            if self.time_per_iteration is None:
+                self.time_per_iteration = time_per_iteration
+            else:
+                self.time_per_iteration = 0.9 * self.time_per_iteration + 0.1 * time_per_iteration
+
+        return result.x.reshape(2, self.num_waypoints)
+
+@traced("waypoint_prediction.target_speed_prediction")
 def target_speed_prediction(waypoints, num_waypoints_used=4,
                             max_speed=30, min_speed=15, K_v=2.5):
     '''
@@ -123,3 +461,25 @@ def target_speed_prediction(waypoints, num_waypoints_used=4,
 
     return target_speed
 
+
+def target_speed_prediction_batch(waypoints, num_waypoints_used=4,
+                                  max_speed=30, min_speed=15, K_v=2.5):
+    '''
+    Batched target_speed_prediction for many vehicles.
+
+    args:
+        waypoints: [B, 2, num_waypoints]
+        num_waypoints_used, max_speed, min_speed, K_v: see target_speed_prediction
+
+    output:
+        target_speed: [B]
+    '''
+    waypoints_used = waypoints[..., :num_waypoints_used]
+
+    delta_waypoints = waypoints_used[..., 1:] - waypoints_used[..., :-1]  # Shape: [B, 2, N-1]
+    delta_waypoints_normalized = delta_waypoints / (np.linalg.norm(delta_waypoints, axis=-2, keepdims=True) + 1e-10)
+    dots = np.sum(delta_waypoints_normalized[..., :-1] * delta_waypoints_normalized[..., 1:], axis=-2)
+    curvature_term = np.sum(1 - dots, axis=-1)
+
+    target_speed = (max_speed - min_speed) * np.exp(-K_v * curvature_term) + min_speed
+    return np.maximum(target_speed, 0)